@@ -0,0 +1,4 @@
+"""
+benchmarks:
+    Performance benchmarks for Simpyl, run with python -m benchmarks
+"""
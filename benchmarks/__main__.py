@@ -0,0 +1,88 @@
+"""
+__main__.py:
+    Runs the benchmarks and writes the results to a JSON file
+
+    python -m benchmarks [--quick] [--only runs,database,cache,api] [--output results.json]
+    python -m benchmarks --compare old.json new.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+from benchmarks import bench_api, bench_cache, bench_database, bench_runs
+
+SUITES = {'runs': bench_runs, 'database': bench_database, 'cache': bench_cache, 'api': bench_api}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suites(names, quick: bool) -> dict:
+    results = []
+    for name in names:
+        for benchmark in SUITES[name].BENCHMARKS:
+            print("running {}.{}".format(name, benchmark.__name__), file=sys.stderr)
+            results += benchmark(quick)
+    return {'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'quick': quick,
+            'results': results}
+
+
+def result_key(result: dict) -> str:
+    return json.dumps([result['name'], result['params']], sort_keys=True)
+
+
+def compare(old: dict, new: dict):
+    """ prints the ratio of the new median time to the old one for each benchmark in both files
+    """
+    old_results = dict((result_key(r), r) for r in old['results'])
+    print("{:>8}  {:>12}  {:>12}  {}".format('ratio', 'old median', 'new median', 'benchmark'))
+    for result in new['results']:
+        old_result = old_results.get(result_key(result))
+        if old_result is None:
+            continue
+        print("{:8.2f}  {:12.6f}  {:12.6f}  {} {}".format(
+            result['median'] / old_result['median'], old_result['median'], result['median'],
+            result['name'], json.dumps(result['params'], sort_keys=True)
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('--quick', action='store_true', help="fewer repeats and only the smaller sizes")
+    parser.add_argument('--only', default=','.join(SUITES), help="comma separated suites to run")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two results files")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            compare(json.load(old), json.load(new))
+        return
+
+    names = args.only.split(',')
+    unknown = [name for name in names if name not in SUITES]
+    if unknown:
+        parser.error("unknown suites: {}".format(', '.join(unknown)))
+    report = run_suites(names, args.quick)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("{} results written to {}".format(len(report['results']), args.output), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
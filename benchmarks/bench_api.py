@@ -0,0 +1,59 @@
+"""
+bench_api.py:
+    Latency of the web API's endpoints, called through Flask's test client
+"""
+from typing import List
+
+import simpyl.webserver as webserver
+from benchmarks.bench_database import populate
+from benchmarks.common import measure, temp_environment, to_result
+
+N_RUNS = 1000
+N_LOG_LINES = 1000
+
+
+def bench_api(quick: bool) -> List[dict]:
+    results = []
+    with temp_environment() as sl:
+        populate(sl.get_environment(), N_RUNS)
+
+        @sl.add_procedure('plot')
+        def plot():
+            import matplotlib.pyplot as plt
+            for i in range(N_LOG_LINES):
+                sl.log("line {} of the benchmark log".format(i))
+            plt.figure()
+            plt.plot(range(100))
+            sl.savefig('benchmark')
+
+        run_id = sl.run([('plot', {})], 'benchmark')['id']
+        figure_name = sl.get_figures(run_id)[0]
+        webserver.sl = sl
+        client = webserver.app.test_client()
+
+        figure_url = '/api/figure/{}/{}'.format(run_id, figure_name)
+        etag = client.get(figure_url).headers['ETag']
+        # the endpoint names the request in the results, as ids and figure names differ between runs
+        requests = [
+            ('/api/runs/', '/api/runs/', {}),
+            ('/api/runs/?limit=max', '/api/runs/?limit={}'.format(webserver.s.RUNS_MAX_PAGE_SIZE), {}),
+            ('/api/run/<id>', '/api/run/{}'.format(run_id), {}),
+            ('/api/log/<id>', '/api/log/{}'.format(run_id), {}),
+            ('/api/log/<id>?offset=0', '/api/log/{}?offset=0'.format(run_id), {}),
+            ('/api/figures/<id>', '/api/figures/{}'.format(run_id), {}),
+            ('/api/figure/<id>/<name>', figure_url, {}),
+            ('/api/figure/<id>/<name> If-None-Match', figure_url, {'If-None-Match': etag}),
+            ('/api/figure/<id>/<name>?size=thumb', figure_url + '?size=thumb', {}),
+        ]
+        for endpoint, url, headers in requests:
+            def get():
+                response = client.get(url, headers=headers)
+                response.close()
+                assert response.status_code in (200, 304), (url, response.status_code)
+
+            params = {'endpoint': endpoint, 'n_runs': N_RUNS, 'n_log_lines': N_LOG_LINES}
+            results.append(to_result('api.get', params, measure(get, repeat=5, number=10 if quick else 50)))
+    return results
+
+
+BENCHMARKS = [bench_api]
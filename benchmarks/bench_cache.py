@@ -0,0 +1,58 @@
+"""
+bench_cache.py:
+    write_cache and read_cache throughput for each cache format and object size
+"""
+import os
+from typing import List
+
+import simpyl.run_manager as runm
+from benchmarks.common import measure, temp_environment, to_result
+
+FORMATS = ['.pkl', '.pkl5', '.npy', '.npz', '.pkl.gz', '.pkl.xz', '.csv']
+# csv and xz are much slower than the binary formats, so they aren't run on the largest object
+SLOW_FORMATS = ['.pkl.xz', '.csv']
+
+
+def make_object(n_bytes: int):
+    """ a float64 array of about n_bytes of random values, which don't compress well
+    """
+    import numpy as np
+    return np.random.default_rng(0).random(max(n_bytes // 8, 1))
+
+
+def bench_cache(quick: bool) -> List[dict]:
+    results = []
+    sizes = [2 ** 10, 2 ** 20] if quick else [2 ** 10, 2 ** 20, 2 ** 26]
+    with temp_environment() as sl:
+        environment = sl.get_environment()
+        for n_bytes in sizes:
+            obj = make_object(n_bytes)
+            repeat, number = (3, 1) if n_bytes >= 2 ** 26 else (5, 2) if n_bytes >= 2 ** 20 else (5, 10)
+            for extension in FORMATS:
+                if n_bytes == sizes[-1] and len(sizes) > 2 and extension in SLOW_FORMATS:
+                    continue
+                filename = 'bench{}'.format(extension)
+                params = {'format': extension, 'n_bytes': n_bytes}
+
+                timing = measure(lambda: runm.write_cache(environment, filename, obj), repeat, number)
+                file_size = os.path.getsize(runm.env_path(environment, filename))
+                results.append(to_result('cache.write', params, timing, file_size=file_size,
+                                         bytes_per_second=n_bytes / timing['median']))
+
+                timing = measure(lambda: runm.read_cache(environment, filename), repeat, number)
+                results.append(to_result('cache.read', params, timing, file_size=file_size,
+                                         bytes_per_second=n_bytes / timing['median']))
+
+                if extension in ['.npy', '.pkl5']:
+                    timing = measure(lambda: runm.read_cache(environment, filename, mmap=True), repeat, number)
+                    results.append(to_result('cache.read_mmap', params, timing, file_size=file_size))
+
+            # a read of an unchanged file served from the in-memory cache
+            sl.write_cache(obj, 'bench.pkl')
+            sl.read_cache('bench.pkl')
+            results.append(to_result('cache.read_memory', {'n_bytes': n_bytes},
+                                     measure(lambda: sl.read_cache('bench.pkl'), repeat=5, number=100)))
+    return results
+
+
+BENCHMARKS = [bench_cache]
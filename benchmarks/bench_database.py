@@ -0,0 +1,70 @@
+"""
+bench_database.py:
+    Latency of inserting and querying runs in databases holding 10^3 to 10^5 runs
+"""
+import itertools
+import time
+from typing import List
+
+import simpyl.database as db
+import simpyl.run_manager as runm
+from benchmarks.common import measure, temp_environment, to_result
+
+PROCS_PER_RUN = 3
+
+
+def populate(environment: str, n_runs: int):
+    """ fills the database with n_runs complete runs in a single transaction.
+        Uses executemany rather than the database functions, which commit each row
+    """
+    db_con = db.get_connection(environment)
+    now = time.time()
+    with db_con:
+        db_con.executemany(
+            "INSERT INTO run_result (timestamp_start, timestamp_stop, description, status, environment) "
+            "VALUES (?,?,?,?,?);",
+            ((now, now + 1, 'run {}'.format(i), 'complete', environment) for i in range(n_runs))
+        )
+        db_con.executemany(
+            "INSERT INTO proc_result (proc_name, run_order, timestamp_start, timestamp_stop, result, "
+            "arguments_str, run_result_id, status) VALUES (?,?,?,?,?,?,?,?);",
+            (('proc_{}'.format(order), order, now, now + 1, 'None', '', run_id, 'complete')
+             for run_id, order in itertools.product(range(1, n_runs + 1), range(PROCS_PER_RUN)))
+        )
+
+
+def bench_database(quick: bool) -> List[dict]:
+    results = []
+    for n_runs in [10 ** 3] if quick else [10 ** 3, 10 ** 4, 10 ** 5]:
+        with temp_environment() as sl:
+            environment = sl.get_environment()
+            populate(environment, n_runs)
+            params = {'n_runs': n_runs, 'procs_per_run': PROCS_PER_RUN}
+
+            def register():
+                run_result = runm.to_run_result({'description': 'benchmark', 'environment': environment})
+                run_result['id'] = db.register_run_result(environment, run_result)
+                for order in range(PROCS_PER_RUN):
+                    proc_result = runm.to_proc_result({'proc_name': 'proc', 'arguments': [], 'arguments_str': ''})
+                    proc_result.update(run_order=order, run_result_id=run_result['id'], status='complete')
+                    db.register_proc_result(environment, proc_result)
+                run_result['status'] = 'complete'
+                db.update_run_result(environment, run_result)
+
+            queries = [
+                ('database.register_run', register),
+                ('database.get_single_run_result', lambda: db.get_single_run_result(environment, n_runs // 2)),
+                ('database.get_run_results_first_page',
+                 lambda: db.get_run_results(environment, limit=100, order='desc')),
+                ('database.get_run_results_middle_page',
+                 lambda: db.get_run_results(environment, after_id=n_runs // 2, limit=100, order='desc')),
+            ]
+            for name, fn in queries:
+                results.append(to_result(name, params, measure(fn, repeat=5, number=20)))
+            if n_runs <= 10 ** 4:
+                results.append(to_result('database.get_run_results_all', params,
+                                         measure(lambda: db.get_run_results(environment), repeat=3)))
+    return results
+
+
+BENCHMARKS = [bench_database]
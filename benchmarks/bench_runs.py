@@ -0,0 +1,61 @@
+"""
+bench_runs.py:
+    Runs per second through Simpyl.run and the run queue, with procedures that do nothing
+"""
+from typing import List
+
+from benchmarks.common import measure, temp_environment, to_result
+
+
+def add_noop_procedures(sl, n_procs: int) -> List[tuple]:
+    """ registers n_procs procedures which return straight away, and returns the procs of a run calling them
+    """
+    procs = []
+    for i in range(n_procs):
+        name = 'noop_{}'.format(i)
+        sl.add_procedure(name)(lambda: None)
+        procs.append((name, {}))
+    return procs
+
+
+def to_run_init(sl, procs: List[tuple], description: str) -> dict:
+    return {'description': description,
+            'environment': sl.get_environment(),
+            'proc_inits': [{'proc_name': name, 'run_order': None, 'arguments': [], 'arguments_str': ''}
+                           for name, _ in procs]}
+
+
+def bench_run(quick: bool) -> List[dict]:
+    results = []
+    for n_procs in [1, 10]:
+        with temp_environment() as sl:
+            procs = add_noop_procedures(sl, n_procs)
+            timing = measure(lambda: sl.run(procs, 'benchmark'), repeat=5, number=10 if quick else 50)
+            results.append(to_result('runs.run', {'n_procs': n_procs}, timing,
+                                     runs_per_second=1 / timing['median']))
+    return results
+
+
+def bench_queue(quick: bool) -> List[dict]:
+    results = []
+    n_runs = 50 if quick else 500
+    for worker_type, max_workers in [('thread', 1), ('thread', 4), ('process', 4)]:
+        with temp_environment() as sl:
+            procs = add_noop_procedures(sl, 1)
+            sl.start_queue(max_workers=max_workers, worker_type=worker_type, preload=())
+
+            def queue_runs():
+                for _ in range(n_runs):
+                    sl.queue_run_init(to_run_init(sl, procs, 'benchmark'), convert_args_to_numbers=False)
+                sl.wait()
+
+            # time per batch of n_runs, from queueing the first to the last finishing
+            timing = measure(queue_runs, repeat=3)
+            results.append(to_result(
+                'runs.queue', {'worker_type': worker_type, 'max_workers': max_workers, 'n_runs': n_runs},
+                timing, runs_per_second=n_runs / timing['median']
+            ))
+    return results
+
+
+BENCHMARKS = [bench_run, bench_queue]
@@ -0,0 +1,56 @@
+"""
+common.py:
+    Timing helpers and fixtures shared by the benchmarks
+"""
+import contextlib
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from typing import Callable, Optional
+
+from simpyl import Simpyl
+import simpyl.database as db
+
+
+def measure(fn: Callable, repeat: int, number: int = 1, setup: Optional[Callable] = None) -> dict:
+    """ calls fn number times in each of repeat rounds and returns statistics of the
+        seconds taken per call. setup is called before each round and isn't timed
+    """
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter() - start) / number)
+    return {'repeat': repeat,
+            'number': number,
+            'min': min(timings),
+            'median': statistics.median(timings),
+            'mean': statistics.mean(timings),
+            'max': max(timings)}
+
+
+def to_result(name: str, params: dict, timing: dict, **extra) -> dict:
+    """ creates a benchmark result. Times are in seconds per call, and extra holds derived
+        figures such as throughput
+    """
+    return dict({'name': name, 'params': params, 'unit': 's'}, **timing, **extra)
+
+
+@contextlib.contextmanager
+def temp_environment():
+    """ yields a Simpyl object using a new environment in a temporary directory
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='simpyl-bench-')
+    environment = os.path.join(tmp_dir, 'env')
+    try:
+        sl = Simpyl()
+        sl.reset_environment(environment)
+        yield sl
+    finally:
+        db.close_connections(environment)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
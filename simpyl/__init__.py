@@ -1,2 +1,9 @@
 from .simpyl import Simpyl
-from .webserver import run_server
+
+
+def __getattr__(name):
+    # the webserver imports Flask, so it is only imported when run_server is first used
+    if name == 'run_server':
+        from .webserver import run_server
+        return run_server
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
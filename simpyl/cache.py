@@ -0,0 +1,73 @@
+"""
+cache.py:
+    In-memory cache of objects loaded from an environment's cache files
+"""
+import collections
+import threading
+from typing import Hashable, Tuple
+
+
+class LRUCache(object):
+    """ a thread-safe least-recently-used cache, bounded by the total size of its entries.
+        Each entry is stored with a version, such as a file's modification time and size,
+        and is only returned while the caller asks for the same version
+    """
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._n_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, version: Hashable) -> Tuple[bool, object]:
+        """ returns (True, obj) for a hit, or (False, None) if the key isn't cached
+            or its version has changed
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, key: Hashable, version: Hashable, obj, n_bytes: int):
+        """ caches obj, evicting the least recently used entries to make room.
+            Objects larger than the whole cache are not stored
+        """
+        with self._lock:
+            self._remove(key)
+            if n_bytes > self._max_bytes:
+                return
+            while self._n_bytes + n_bytes > self._max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            self._entries[key] = (version, obj, n_bytes)
+            self._n_bytes += n_bytes
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._n_bytes = 0
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'n_bytes': self._n_bytes,
+                    'max_bytes': self._max_bytes}
+
+    def _remove(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._n_bytes -= entry[2]
@@ -2,12 +2,40 @@
 database.py:
     File for connecting to an sqlite database to store the data
 """
+import functools
+import heapq
+import itertools
+import json
+import logging
 import os
 import sqlite3
-from typing import List, Optional
+import threading
+import time
+import weakref
+from typing import Callable, List, Optional
 
 import simpyl.settings as s
 
+# kept below SQLITE_MAX_VARIABLE_NUMBER of older SQLite builds
+_MAX_QUERY_PARAMS = 500
+# the resources used by a procedure call, as measured by run_manager.resource_usage
+RESOURCE_COLUMNS = ('cpu_user', 'cpu_system', 'max_rss_delta', 'io_read_bytes', 'io_write_bytes',
+                    'cache_bytes_read', 'cache_bytes_written')
+SORT_ORDERS = ('asc', 'desc')
+
+
+def _json_default(obj):
+    """ converts the values json can't encode, such as the numpy values of a sweep's arguments.
+        Arrays and numpy scalars become lists and numbers, and anything else its repr
+    """
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return repr(obj)
+
+
+def to_json(obj) -> str:
+    return json.dumps(obj, default=_json_default)
+
 
 def construct_dict(cursor):
     """ transforms the sqlite cursor rows from table format to a
@@ -18,30 +46,206 @@ def construct_dict(cursor):
             for row in rows]
 
 
+# each thread keeps one open connection per database, closed when the thread exits.
+# Connections are also registered globally with a generation number, so closing them
+# for a reset is seen by every thread
+_local = threading.local()
+# reentrant, as a thread's connections may be closed by garbage collection while it holds the lock
+_pool_lock = threading.RLock()
+_pool = {}
+_generations = {}
+
+
+def _close_thread_connections(connections: dict):
+    with _pool_lock:
+        for path, (_, db_con) in connections.items():
+            _pool.get(path, set()).discard(db_con)
+            db_con.close()
+        connections.clear()
+
+
+class _ThreadConnections(object):
+    """ the connections of one thread. The thread's local data, and so this object,
+        is released when the thread exits, which closes its connections
+    """
+
+    def __init__(self):
+        self.connections = {}
+        weakref.finalize(self, _close_thread_connections, self.connections)
+
+
+def db_path(environment: str) -> str:
+    return os.path.abspath(os.path.join(environment, s.DB_FILENAME))
+
+
+def get_connection(environment: str) -> sqlite3.Connection:
+    """ gets the calling thread's connection to the environment's database,
+        opening and configuring a new one if needed
+    """
+    path = db_path(environment)
+    thread_connections = getattr(_local, 'thread_connections', None)
+    if thread_connections is None:
+        thread_connections = _local.thread_connections = _ThreadConnections()
+    connections = thread_connections.connections
+    key = (os.getpid(), _generations.get(path, 0))
+    pooled = connections.get(path)
+    if pooled is not None and pooled[0] == key:
+        return pooled[1]
+
+    # check_same_thread is off only so close_connections can close it from another thread
+    db_con = sqlite3.connect(path, timeout=s.DB_TIMEOUT, check_same_thread=False)
+    for pragma in s.DB_PRAGMAS:
+        db_con.execute(pragma)
+    connections[path] = (key, db_con)
+    with _pool_lock:
+        _pool.setdefault(path, set()).add(db_con)
+    return db_con
+
+
+def close_connections(environment: str):
+    """ closes every thread's pooled connection to the environment's database
+    """
+    path = db_path(environment)
+    with _pool_lock:
+        _generations[path] = _generations.get(path, 0) + 1
+        for db_con in _pool.pop(path, set()):
+            db_con.close()
+
+
 def with_db(fn):
-    """ Decorator to handle opening and closing of database connections
-        This replaces the db connection argument with at Simpyl object,
-        which can be used to determine the correct database
+    """ Decorator to handle database connections
+        This replaces the db connection argument with the environment name,
+        which is used to get the calling thread's pooled connection to the correct database
     """
 
+    @functools.wraps(fn)
     def new_fn(environment: str, *args, **kwargs):
-        db_con = sqlite3.connect(
-            os.path.join(environment, s.DB_FILENAME)
-        )
-        result = fn(db_con, *args, **kwargs)
+        db_con = get_connection(environment)
+        try:
+            result = fn(db_con, *args, **kwargs)
+        except BaseException:
+            db_con.rollback()
+            raise
         db_con.commit()
-        db_con.close()
         return result
 
     return new_fn
 
 
-def reset_database(environment: str):
-    """ deletes all data in the current database and creates a new one with a default environment entry
+# sessions waiting to be flushed by the flusher thread, as a heap of (deadline, sequence, session)
+_flush_condition = threading.Condition()
+_flush_heap = []
+_flush_sequence = itertools.count()
+_flusher_pid = None
+
+
+def _flusher():
+    while True:
+        with _flush_condition:
+            while not _flush_heap or _flush_heap[0][0] > time.monotonic():
+                _flush_condition.wait(_flush_heap[0][0] - time.monotonic() if _flush_heap else None)
+            _, _, session = heapq.heappop(_flush_heap)
+        session.flush(raise_errors=False)
+
+
+def _schedule_flush(session, deadline: float):
+    global _flusher_pid
+    with _flush_condition:
+        # threads don't survive a fork, so each process starts its own flusher
+        if _flusher_pid != os.getpid():
+            _flush_heap.clear()
+            threading.Thread(target=_flusher, name='simpyl-db-flusher', daemon=True).start()
+            _flusher_pid = os.getpid()
+        heapq.heappush(_flush_heap, (deadline, next(_flush_sequence), session))
+        # the flusher only needs waking if it is now waiting for a later deadline
+        if _flush_heap[0][2] is session:
+            _flush_condition.notify()
+
+
+class WriteSession(object):
+    """ buffers a run's writes to the database so that they are committed together in one
+        transaction instead of one each. Writes are committed in the order they were added,
+        when flush is called and at most flush_interval seconds after they were added
+
+        Writes are buffered rather than left in an open transaction, so other runs aren't
+        locked out of the database between commits. Until a write is flushed it isn't seen
+        by any connection, including the caller's
     """
-    _create_tables_sql = [
+
+    def __init__(self, environment: str, flush_interval: float = s.DB_FLUSH_INTERVAL):
+        self._environment = environment
+        self._flush_interval = flush_interval
+        self._pending = []
+        self._oldest = None
+        self._error = None
+        self._lock = threading.Lock()
+        # held while committing, so flushes from different threads are committed in order
+        self._flush_lock = threading.Lock()
+
+    def add(self, fn, *args, on_result: Optional[Callable] = None, **kwargs):
+        """ buffers a call to a with_db function. Once it's committed, on_result
+            is called with its return value, such as the id of an inserted row
+        """
+        with self._lock:
+            self._pending.append((fn.__wrapped__, args, kwargs, on_result))
+            schedule = self._oldest is None
+            if schedule:
+                self._oldest = time.monotonic()
+        if schedule:
+            _schedule_flush(self, self._oldest + self._flush_interval)
+
+    def flush_if_due(self):
+        """ flushes if the oldest buffered write has waited for the flush interval
+        """
+        with self._lock:
+            due = self._oldest is not None and time.monotonic() - self._oldest >= self._flush_interval
+        if due:
+            self.flush()
+
+    def flush(self, raise_errors: bool = True):
+        """ commits the buffered writes in one transaction. A write that failed when flushed
+            in the background is raised by the next flush
         """
-        CREATE TABLE run_result (
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending, self._oldest = self._pending, [], None
+            if pending:
+                db_con = get_connection(self._environment)
+                try:
+                    results = [fn(db_con, *args, **kwargs) for fn, args, kwargs, _ in pending]
+                    db_con.commit()
+                except Exception as error:
+                    db_con.rollback()
+                    logging.exception("[simpyl logged] failed to write run results to the database")
+                    self._error = self._error or error
+                else:
+                    for (_, _, _, on_result), result in zip(pending, results):
+                        if on_result is not None:
+                            on_result(result)
+            if raise_errors and self._error is not None:
+                error, self._error = self._error, None
+                raise error
+
+    def close(self):
+        self.flush()
+
+
+def _backfill_figures(db_con, environment: str):
+    # imported here as run_manager imports this module
+    import simpyl.run_manager as runm
+
+    for figure in runm.find_figures(environment):
+        _insert_figure(db_con, figure, or_ignore=True)
+
+
+# Each migration upgrades the schema by one version, recorded in PRAGMA user_version.
+# A migration is a list of SQL statements or functions called with (db_con, environment).
+# Only ever append to this list, as existing databases have already applied the earlier entries
+_MIGRATIONS = [
+    # 1: the original tables. IF NOT EXISTS upgrades databases made before versioning
+    [
+        """
+        CREATE TABLE IF NOT EXISTS run_result (
             id INTEGER PRIMARY KEY,
             timestamp_start REAL,
             timestamp_stop REAL,
@@ -52,7 +256,7 @@ def reset_database(environment: str):
         );
         """,
         """
-        CREATE TABLE proc_result (
+        CREATE TABLE IF NOT EXISTS proc_result (
             id INTEGER PRIMARY KEY,
             proc_name TEXT,
             run_order INTEGER,
@@ -64,23 +268,129 @@ def reset_database(environment: str):
             FOREIGN KEY(run_result_id) REFERENCES run_result(id)
         );
         """
+    ],
+    # 2: indexes for looking up the procedures of a run and filtering runs
+    [
+        "CREATE INDEX IF NOT EXISTS proc_result_run_order ON proc_result(run_result_id, run_order);",
+        "CREATE INDEX IF NOT EXISTS run_result_status ON run_result(status);",
+        "CREATE INDEX IF NOT EXISTS run_result_timestamp_start ON run_result(timestamp_start);"
+    ],
+    # 3: whether a procedure was called or its memoized result was used
+    [
+        "ALTER TABLE proc_result ADD COLUMN status TEXT DEFAULT 'complete';"
+    ],
+    # 4: an index of the figures saved by each run, filled in for existing runs
+    [
+        """
+        CREATE TABLE figure (
+            id INTEGER PRIMARY KEY,
+            run_result_id INTEGER,
+            proc_name TEXT,
+            title TEXT,
+            filename TEXT,
+            size INTEGER,
+            width INTEGER,
+            height INTEGER,
+            timestamp REAL,
+            FOREIGN KEY(run_result_id) REFERENCES run_result(id)
+        );
+        """,
+        "CREATE UNIQUE INDEX figure_run_filename ON figure(run_result_id, filename);",
+        _backfill_figures
+    ],
+    # 5: a JSON summary of the procedure's profile, for runs started with profiling on
+    [
+        "ALTER TABLE proc_result ADD COLUMN profile TEXT;"
+    ],
+    # 6: the resources used by each procedure call
+    [
+        "ALTER TABLE proc_result ADD COLUMN cpu_user REAL;",
+        "ALTER TABLE proc_result ADD COLUMN cpu_system REAL;",
+        "ALTER TABLE proc_result ADD COLUMN max_rss_delta INTEGER;",
+        "ALTER TABLE proc_result ADD COLUMN io_read_bytes INTEGER;",
+        "ALTER TABLE proc_result ADD COLUMN io_write_bytes INTEGER;",
+        "ALTER TABLE proc_result ADD COLUMN cache_bytes_read INTEGER;",
+        "ALTER TABLE proc_result ADD COLUMN cache_bytes_written INTEGER;"
+    ],
+    # 7: sweeps, which group runs made from a grid of procedure arguments
+    [
+        """
+        CREATE TABLE sweep (
+            id INTEGER PRIMARY KEY,
+            description TEXT,
+            timestamp REAL,
+            environment TEXT,
+            spec TEXT,
+            n_runs INTEGER
+        );
+        """,
+        "ALTER TABLE run_result ADD COLUMN sweep_id INTEGER REFERENCES sweep(id);",
+        "ALTER TABLE run_result ADD COLUMN sweep_params TEXT;",
+        "CREATE INDEX run_result_sweep ON run_result(sweep_id);"
+    ],
+    # 8: failed runs' tracebacks, and what is needed to resume them
+    [
+        "ALTER TABLE run_result ADD COLUMN traceback TEXT;",
+        "ALTER TABLE run_result ADD COLUMN resumed_from INTEGER REFERENCES run_result(id);",
+        """
+        CREATE TABLE run_init (
+            run_result_id INTEGER PRIMARY KEY REFERENCES run_result(id),
+            data BLOB
+        );
+        """
     ]
+]
+SCHEMA_VERSION = len(_MIGRATIONS)
+
 
-    db_path = os.path.join(environment, s.DB_FILENAME)
+def get_schema_version(environment: str) -> int:
+    return get_connection(environment).execute("PRAGMA user_version").fetchone()[0]
 
-    # remove the file if it exists
-    try:
-        os.remove(db_path)
-    except OSError:
-        pass
 
-    # create the database tables
-    db_con = sqlite3.connect(db_path)
-    for _create_table_sql in _create_tables_sql:
-        db_con.execute(_create_table_sql)
+def migrate_database(environment: str) -> int:
+    """ upgrades the environment's database to the latest schema in place,
+        applying each migration in its own transaction. returns the new schema version
+    """
+    db_con = get_connection(environment)
+    while True:
+        # the version is read inside the transaction, in case another process migrates at the same time
+        db_con.execute("BEGIN IMMEDIATE")
+        try:
+            version = db_con.execute("PRAGMA user_version").fetchone()[0]
+            if version > SCHEMA_VERSION:
+                raise ValueError(
+                    "database schema version {} is newer than this version of simpyl ({})".format(
+                        version, SCHEMA_VERSION
+                    )
+                )
+            if version == SCHEMA_VERSION:
+                db_con.rollback()
+                return version
+            for step in _MIGRATIONS[version]:
+                if callable(step):
+                    step(db_con, environment)
+                else:
+                    db_con.execute(step)
+            db_con.execute("PRAGMA user_version = {:d}".format(version + 1))
+        except BaseException:
+            db_con.rollback()
+            raise
+        db_con.commit()
+
+
+def reset_database(environment: str):
+    """ deletes all data in the current database and creates a new one with the latest schema
+    """
+    close_connections(environment)
+
+    # remove the file and its write-ahead log if they exist
+    for suffix in ['', '-wal', '-shm']:
+        try:
+            os.remove(db_path(environment) + suffix)
+        except OSError:
+            pass
 
-    db_con.commit()
-    db_con.close()
+    migrate_database(environment)
 
 
 @with_db
@@ -93,20 +403,24 @@ def register_run_result(db_con, run_result: dict) -> Optional[int]:
     # check that the id field is empty
     if run_result['id'] is not None:
         return None
-    cur = db_con.cursor()
-    cur.execute("PRAGMA database_list")
-    rows = cur.fetchall()
+    # return the run id just created
+    return _insert_run_result(db_con, run_result)
 
-    for row in rows:
-        print(row[0], row[1], row[2])
 
-    cursor = db_con.execute("INSERT INTO run_result VALUES (NULL,?,?,?,?,?);",
+def _insert_run_result(db_con, run_result: dict) -> int:
+    sweep_params = run_result.get('sweep_params')
+    cursor = db_con.execute("""
+        INSERT INTO run_result (timestamp_start, timestamp_stop, description, status, environment,
+                                sweep_id, sweep_params, resumed_from)
+        VALUES (?,?,?,?,?,?,?,?);""",
                             [run_result['timestamp_start'],
                              run_result['timestamp_stop'],
                              run_result['description'],
                              run_result['status'],
-                             run_result['environment']])
-    # return the run id just created
+                             run_result['environment'],
+                             run_result.get('sweep_id'),
+                             None if sweep_params is None else to_json(sweep_params),
+                             run_result.get('resumed_from')])
     return cursor.lastrowid
 
 
@@ -116,13 +430,14 @@ def update_run_result(db_con, run_result: dict) -> int:
     """
     _update_run_result_sql = """
     UPDATE run_result SET timestamp_start=?, timestamp_stop=?, description=?, status=?,
-    environment = ? WHERE id = ?;
+    environment = ?, traceback = ? WHERE id = ?;
     """
     db_con.execute(_update_run_result_sql, [run_result['timestamp_start'],
                                             run_result['timestamp_stop'],
                                             run_result['description'],
                                             run_result['status'],
                                             run_result['environment'],
+                                            run_result.get('traceback'),
                                             run_result['id']])
     return run_result['id']
 
@@ -139,25 +454,62 @@ def _get_proc_results(db_con, run_id: int = None) -> List[dict]:
     return construct_dict(cursor)
 
 
-@with_db
-def get_run_results(db_con) -> List[dict]:
-    """ gets all runs from the given environment
+def _add_proc_results(db_con, runs: List[dict]) -> List[dict]:
+    """ sets the proc_results of each run, fetching them for many runs per query
     """
-    cursor = db_con.execute("SELECT * FROM run_result;")
-    runs = construct_dict(cursor)
+    runs_by_id = {}
     for run in runs:
-        run['proc_results'] = _get_proc_results(db_con, run_id=run['id'])
+        run['proc_results'] = []
+        if run['sweep_params'] is not None:
+            run['sweep_params'] = json.loads(run['sweep_params'])
+        runs_by_id[run['id']] = run
+
+    run_ids = list(runs_by_id)
+    for i in range(0, len(run_ids), _MAX_QUERY_PARAMS):
+        chunk = run_ids[i:i + _MAX_QUERY_PARAMS]
+        cursor = db_con.execute(
+            "SELECT * FROM proc_result WHERE run_result_id IN ({}) ORDER BY run_result_id, run_order".format(
+                ",".join("?" * len(chunk))
+            ),
+            chunk
+        )
+        for proc_result in construct_dict(cursor):
+            if proc_result['profile'] is not None:
+                proc_result['profile'] = json.loads(proc_result['profile'])
+            runs_by_id[proc_result['run_result_id']]['proc_results'].append(proc_result)
     return runs
 
 
+@with_db
+def get_run_results(db_con,
+                    after_id: Optional[int] = None,
+                    limit: Optional[int] = None,
+                    order: str = 'asc') -> List[dict]:
+    """ gets runs from the given environment, sorted by id in the given order ('asc' or 'desc').
+        To page through the runs, pass the id of the last run of the previous page as after_id.
+        By default all runs are returned
+    """
+    if order not in SORT_ORDERS:
+        raise ValueError("order must be one of {}".format(SORT_ORDERS))
+    sql = "SELECT * FROM run_result"
+    params = []
+    if after_id is not None:
+        sql += " WHERE id {} ?".format('>' if order == 'asc' else '<')
+        params += [after_id]
+    sql += " ORDER BY id {}".format(order.upper())
+    if limit is not None:
+        sql += " LIMIT ?"
+        params += [limit]
+    cursor = db_con.execute(sql, params)
+    return _add_proc_results(db_con, construct_dict(cursor))
+
+
 @with_db
 def get_single_run_result(db_con, run_result_id: int) -> Optional[dict]:
     """ gets a specific run
     """
     cursor = db_con.execute("SELECT * FROM run_result WHERE id = ?;", [run_result_id])
-    runs = construct_dict(cursor)
-    for run in runs:
-        run['proc_results'] = _get_proc_results(db_con, run_id=run['id'])
+    runs = _add_proc_results(db_con, construct_dict(cursor))
     if len(runs) != 1:
         return None
     return runs[0]
@@ -173,13 +525,104 @@ def register_proc_result(db_con, proc_result: dict) -> Optional[int]:
     # check that the id field is empty
     if proc_result['id'] is not None:
         return None
-    cursor = db_con.execute("INSERT INTO proc_result VALUES (NULL,?,?,?,?,?,?,?);",
+    cursor = db_con.execute("""
+        INSERT INTO proc_result (proc_name, run_order, timestamp_start, timestamp_stop,
+                                 result, arguments_str, run_result_id, status, profile,
+                                 cpu_user, cpu_system, max_rss_delta, io_read_bytes, io_write_bytes,
+                                 cache_bytes_read, cache_bytes_written)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?);""",
                             [proc_result['proc_name'],
                              proc_result['run_order'],
                              proc_result['timestamp_start'],
                              proc_result['timestamp_stop'],
                              str(proc_result['result']),
                              proc_result['arguments_str'],
-                             proc_result['run_result_id']])
+                             proc_result['run_result_id'],
+                             proc_result.get('status', 'complete'),
+                             None if proc_result.get('profile') is None else to_json(proc_result['profile'])] +
+                            [proc_result.get(column) for column in RESOURCE_COLUMNS])
     return cursor.lastrowid
 
+
+def _insert_figure(db_con, figure: dict, or_ignore: bool = False) -> int:
+    cursor = db_con.execute("""
+        INSERT {} INTO figure (run_result_id, proc_name, title, filename, size, width, height, timestamp)
+        VALUES (?,?,?,?,?,?,?,?);""".format('OR IGNORE' if or_ignore else ''),
+                            [figure['run_result_id'],
+                             figure['proc_name'],
+                             figure['title'],
+                             figure['filename'],
+                             figure['size'],
+                             figure['width'],
+                             figure['height'],
+                             figure['timestamp']])
+    return cursor.lastrowid
+
+
+@with_db
+def register_figure(db_con, figure: dict) -> Optional[int]:
+    """ adds a figure saved by a run to the database
+        The id field of figure must be empty, as this is automatically calculated by the database
+
+        returns the ID of the entered field, or None if it was not created
+    """
+    if figure['id'] is not None:
+        return None
+    return _insert_figure(db_con, figure)
+
+
+@with_db
+def get_figures(db_con, run_result_id: int) -> List[dict]:
+    """ gets the figures saved by a run, in the order they were saved
+    """
+    cursor = db_con.execute("SELECT * FROM figure WHERE run_result_id = ? ORDER BY id;", [run_result_id])
+    return construct_dict(cursor)
+
+
+@with_db
+def register_sweep(db_con, sweep: dict, run_results: List[dict]) -> int:
+    """ adds a sweep and all of its runs to the database in one transaction,
+        setting the id and sweep_id of each run_result
+
+        returns the ID of the sweep
+    """
+    cursor = db_con.execute("""
+        INSERT INTO sweep (description, timestamp, environment, spec, n_runs)
+        VALUES (?,?,?,?,?);""",
+                            [sweep['description'],
+                             sweep['timestamp'],
+                             sweep['environment'],
+                             to_json(sweep['spec']),
+                             len(run_results)])
+    sweep_id = cursor.lastrowid
+    for run_result in run_results:
+        run_result['sweep_id'] = sweep_id
+        run_result['id'] = _insert_run_result(db_con, run_result)
+    return sweep_id
+
+
+@with_db
+def get_sweep(db_con, sweep_id: int) -> Optional[dict]:
+    """ gets a sweep with all of its runs, in the order they were made
+    """
+    sweeps = construct_dict(db_con.execute("SELECT * FROM sweep WHERE id = ?;", [sweep_id]))
+    if len(sweeps) != 1:
+        return None
+    sweep = sweeps[0]
+    sweep['spec'] = json.loads(sweep['spec'])
+    cursor = db_con.execute("SELECT * FROM run_result WHERE sweep_id = ? ORDER BY id;", [sweep_id])
+    sweep['run_results'] = _add_proc_results(db_con, construct_dict(cursor))
+    return sweep
+
+
+@with_db
+def register_run_init(db_con, run_result_id: int, data: bytes):
+    """ stores the serialised run_init a run was started with, so it can be resumed
+    """
+    db_con.execute("INSERT OR REPLACE INTO run_init (run_result_id, data) VALUES (?,?);", [run_result_id, data])
+
+
+@with_db
+def get_run_init(db_con, run_result_id: int) -> Optional[bytes]:
+    row = db_con.execute("SELECT data FROM run_init WHERE run_result_id = ?;", [run_result_id]).fetchone()
+    return None if row is None else row[0]
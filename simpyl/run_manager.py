@@ -1,17 +1,43 @@
 import os
+import cProfile
 import errno
+import gzip
+import hashlib
+import inspect
+import itertools
+import math
 import logging
+import logging.handlers
+import lzma
+import mmap as mmap_module
 import pickle
-import numpy as np
-import matplotlib.pyplot as plt
+import pstats
+import queue
+import random
+import struct
+import sys
 import glob
+import threading
+import time
+import traceback
+import tracemalloc
+import types
 import uuid
 import shutil
-from typing import List, Tuple
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:
+    # resource is only available on unix
+    resource = None
 
 import simpyl.database as db
 import simpyl.settings as s
 
+# numpy and matplotlib.pyplot are slow to import, so they are imported by the functions that use them.
+# This keeps `import simpyl` fast for scripts and workers which never cache arrays or draw a figure
+
 
 def create_dir_if_needed(path: str):
     try:
@@ -35,19 +61,167 @@ def to_number(string):
             return string
 
 
-def run_logger(environment: str, run_result_id: int):
-    """ sets up the logger for the Simpyl object to log to an appropriate file
+class BufferedFileHandler(logging.Handler):
+    """ queues formatted log records to be written to a file by a background thread,
+        so logging doesn't wait for the disk. The writer flushes the file in batches,
+        at most flush_interval seconds after a record is written.
+        When max_queued records are waiting, overflow 'block' waits for space and 'drop'
+        discards the record, noting how many were dropped in the file when it is closed
+    """
+
+    def __init__(self,
+                 filename: str,
+                 mode: str = 'a',
+                 max_queued: int = s.LOG_QUEUE_SIZE,
+                 overflow: str = s.LOG_OVERFLOW,
+                 flush_interval: float = s.LOG_FLUSH_INTERVAL):
+        super().__init__()
+        if overflow not in ['block', 'drop']:
+            raise ValueError("overflow must be 'block' or 'drop'")
+        self.overflow = overflow
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        # lone surrogates, such as undecodable bytes from os functions, are escaped rather than failing the write
+        self._file = open(filename, mode, encoding='utf-8', errors='backslashreplace')
+        self._queue = queue.Queue(max_queued)
+        self._closed = False
+        self._writer = threading.Thread(target=self._write, name='simpyl-log-writer', daemon=True)
+        self._writer.start()
+
+    def emit(self, record):
+        if self._closed:
+            return
+        try:
+            line = self.format(record) + '\n'
+        except Exception:
+            self.handleError(record)
+            return
+        if self.overflow == 'block':
+            self._queue.put(line)
+            return
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        unflushed = False
+        last_flush = time.monotonic()
+        while True:
+            # wait for a record, or until unflushed records are due to be flushed
+            timeout = max(0.0, last_flush + self.flush_interval - time.monotonic()) if unflushed else None
+            try:
+                line = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                line = ''
+            if line is None:
+                break
+            if isinstance(line, threading.Event):
+                # a flush request, set once everything queued before it is written
+                unflushed, last_flush = False, time.monotonic()
+                try:
+                    self._file.flush()
+                except Exception:
+                    self._handle_write_error()
+                line.set()
+                continue
+            try:
+                if line:
+                    self._file.write(line)
+                    unflushed = True
+                if unflushed and time.monotonic() - last_flush >= self.flush_interval:
+                    unflushed = False
+                    last_flush = time.monotonic()
+                    self._file.flush()
+            except Exception:
+                # the writer carries on with the next record, so one failed write doesn't lose the rest
+                self._handle_write_error()
+
+    def _handle_write_error(self):
+        """ reports an error writing to the file as logging.Handler.handleError does for a record
+        """
+        if logging.raiseExceptions and sys.stderr:
+            sys.stderr.write("--- Logging error ---\n")
+            traceback.print_exc(file=sys.stderr)
+
+    def flush(self):
+        """ waits for the records queued so far to be written to the file
+        """
+        if self._closed or not self._writer.is_alive():
+            return
+        written = threading.Event()
+        self._queue.put(written)
+        written.wait()
+
+    def close(self):
+        """ waits for the queued records to be written, then closes the file
+        """
+        with self.lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(None)
+        self._writer.join()
+        if self.dropped:
+            self._file.write("[simpyl logged] {} log records were dropped as the log queue was full\n".format(
+                self.dropped
+            ))
+        self._file.close()
+        super().close()
+
+
+def run_logger(environment: str, run_result_id: int, mode: str = 'w'):
+    """ sets up the logger for the Simpyl object to log to an appropriate file.
+        Close it with close_logger when the run is finished
     """
     logger = logging.Logger('run_handler')
-    handler = logging.FileHandler(
+    handler = BufferedFileHandler(
         run_path(environment, run_result_id, s.LOGFILE_FORMAT.format(run_result_id)),
-        mode='w'
+        mode=mode
     )
     handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
     logger.addHandler(handler)
     return logger
 
 
+class EventHandler(logging.handlers.QueueHandler):
+    """ sends log records from a process worker back to the parent process,
+        tagged with the run they belong to
+    """
+
+    def __init__(self, send_event, run_result_id: int):
+        super().__init__(None)
+        self.send_event = send_event
+        self.run_result_id = run_result_id
+
+    def enqueue(self, record):
+        self.send_event(('log', self.run_result_id, record))
+
+
+def event_logger(send_event, run_result_id: int):
+    """ sets up the logger for a Simpyl object in a process worker. The records are
+        written to the run's log file by the parent process
+    """
+    logger = logging.Logger('event_handler')
+    logger.addHandler(EventHandler(send_event, run_result_id))
+    return logger
+
+
+def flush_logger(logger: logging.Logger):
+    """ waits for the records logged so far to be written by all the handlers of a logger
+    """
+    for handler in logger.handlers:
+        handler.flush()
+
+
+def close_logger(logger: logging.Logger):
+    """ closes and removes all the handlers of a logger
+    """
+    for handler in list(logger.handlers):
+        handler.close()
+        logger.removeHandler(handler)
+
+
 def stream_logger():
     """ sets up the logger for the Simpyl object to log to the output
     """
@@ -82,33 +256,286 @@ def get_log(environment: str, run_result_id: int) -> str:
         return ''.join(f.readlines())
 
 
+def detach_current_figure():
+    """ gets pyplot's current figure and closes all the pyplot figures, so the figure can be
+        saved while pyplot is used to draw the next one
+    """
+    import matplotlib.pyplot as plt
+
+    fig = plt.gcf()
+    plt.close('all')
+    return fig
+
+
+RESOURCE_USAGE_KEYS = ('cpu_user', 'cpu_system', 'max_rss', 'io_read_bytes', 'io_write_bytes')
+
+
+def resource_usage() -> dict:
+    """ gets the cpu time and the bytes read and written by the calling thread, and the peak
+        resident memory of the process. Values which can't be measured on this platform are None
+    """
+    usage = dict.fromkeys(RESOURCE_USAGE_KEYS)
+    if resource is not None:
+        rusage = resource.getrusage(getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF))
+        usage['cpu_user'] = rusage.ru_utime
+        usage['cpu_system'] = rusage.ru_stime
+        # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+        usage['max_rss'] = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+    for path in ['/proc/thread-self/io', '/proc/self/io']:
+        try:
+            with open(path) as f:
+                counters = dict(line.split(': ') for line in f.read().splitlines())
+        except OSError:
+            continue
+        # rchar and wchar count all bytes passed to read and write calls,
+        # including reads served from the page cache
+        usage['io_read_bytes'] = int(counters['rchar'])
+        usage['io_write_bytes'] = int(counters['wchar'])
+        break
+    return usage
+
+
+def resource_usage_delta(before: dict, after: dict) -> dict:
+    """ converts two resource_usage readings to the resource columns of a proc_result
+    """
+    delta = dict(
+        (key, None if before[key] is None else after[key] - before[key]) for key in RESOURCE_USAGE_KEYS
+    )
+    delta['max_rss_delta'] = delta.pop('max_rss')
+    return delta
+
+
+# the number of profiled calls tracing memory at the moment, which share tracemalloc's process-wide tracing
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_calls = 0
+_tracemalloc_started = False
+
+
+def _start_tracing_memory():
+    """ starts tracemalloc for a call, unless it's already tracing
+    """
+    global _tracemalloc_calls, _tracemalloc_started
+    with _tracemalloc_lock:
+        if _tracemalloc_calls == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracemalloc_started = True
+        _tracemalloc_calls += 1
+
+
+def _stop_tracing_memory():
+    """ stops tracemalloc once the last call tracing memory has finished, if it was started for them
+    """
+    global _tracemalloc_calls, _tracemalloc_started
+    with _tracemalloc_lock:
+        _tracemalloc_calls -= 1
+        if _tracemalloc_calls == 0 and _tracemalloc_started:
+            tracemalloc.stop()
+            _tracemalloc_started = False
+
+
+def profile_call(environment: str,
+                 run_result_id: int,
+                 run_order: int,
+                 proc_name: str,
+                 trace_memory: bool,
+                 fn, *args, **kwargs):
+    """ calls fn with cProfile, saving the stats to a .prof file next to the run's log.
+        If trace_memory is True, tracemalloc also records the memory allocated during the call
+        and the largest allocation sites are written to a text report.
+        returns the result of fn and a summary of the profile
+
+        tracemalloc traces the whole process, so the allocations of runs on other threads
+        are included, and the peak is the highest since tracing started, which was before the call
+        if it overlaps another call tracing memory. On Python versions which only allow one profiler
+        at a time, a procedure running alongside another profiled procedure is not profiled
+    """
+    summary = {}
+    if trace_memory:
+        _start_tracing_memory()
+        snapshot_before = tracemalloc.take_snapshot()
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        profiler = None
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        if trace_memory:
+            try:
+                snapshot_after = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                _stop_tracing_memory()
+
+    if profiler is not None:
+        filename = s.PROFILE_FORMAT.format(run_order, proc_name)
+        profiler.dump_stats(run_path(environment, run_result_id, filename))
+        stats = pstats.Stats(profiler)
+        top_functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+        summary.update({
+            'profile_file': filename,
+            'total_time': stats.total_tt,
+            'top_functions': [
+                {'function': pstats.func_std_string(func),
+                 'ncalls': ncalls,
+                 'tottime': tottime,
+                 'cumtime': cumtime}
+                for func, (_, ncalls, tottime, cumtime, _) in top_functions[:s.PROFILE_TOP_N]
+            ]
+        })
+
+    if trace_memory:
+        filename = s.MEMORY_REPORT_FORMAT.format(run_order, proc_name)
+        top_allocations = snapshot_after.compare_to(snapshot_before, 'lineno')[:s.PROFILE_TOP_N]
+        with open(run_path(environment, run_result_id, filename), 'w') as f:
+            f.write("peak traced memory: {} bytes\n".format(peak))
+            f.writelines("{}\n".format(stat) for stat in top_allocations)
+        summary.update({
+            'memory_file': filename,
+            'peak_memory': peak,
+            'top_allocations': [
+                {'location': str(stat.traceback), 'size_diff': stat.size_diff, 'count_diff': stat.count_diff}
+                for stat in top_allocations
+            ]
+        })
+    return result, summary
+
+
+def read_log(environment: str,
+             run_result_id: int,
+             offset: int = 0,
+             max_bytes: Optional[int] = s.LOG_CHUNK_BYTES) -> Tuple[str, int]:
+    """ reads the complete lines written to a run's log file after the byte offset, up to max_bytes.
+        returns the text and the offset to read from next time. A log that doesn't exist yet is empty
+    """
+    fn = run_path(
+        environment, run_result_id, s.LOGFILE_FORMAT.format(run_result_id)
+    )
+    try:
+        with open(fn, 'rb') as f:
+            f.seek(offset)
+            data = f.read(-1 if max_bytes is None else max_bytes)
+    except FileNotFoundError:
+        return '', offset
+    # leave a partly written last line for next time, unless a single line fills the whole chunk
+    end = data.rfind(b'\n') + 1
+    if end > 0:
+        data = data[:end]
+    elif max_bytes is None or len(data) < max_bytes:
+        data = b''
+    return data.decode('utf-8', errors='replace'), offset + len(data)
+
+
 def savefig(environment: str,
             run_result_id: int,
             proc_name: str,
             title: str,
-            *args, **kwargs):
+            *args, fig=None, **kwargs):
     """ saves a figure to the run folder. *args and **kwargs are passed to the
-        matplotlib.savefig function
-    """
-    # this saves the current figure
-    # TODO: pass in figure as an argument
-    plt.savefig(
-        run_path(
-            environment, run_result_id,
-            s.FIGURE_FORMAT.format(proc_name, title, str(uuid.uuid4()))
-        ), *args, **kwargs
-    )
-    plt.close('all')
+        matplotlib.savefig function. If fig is None, pyplot's current figure is saved
+        and all the pyplot figures are closed
+    """
+    if fig is None:
+        fig = detach_current_figure()
+    filename = s.FIGURE_FORMAT.format(proc_name, title, str(uuid.uuid4()))
+    fig.savefig(run_path(environment, run_result_id, filename), *args, **kwargs)
+    return to_figure(environment, run_result_id, proc_name, title, filename)
+
+
+def png_size(path: str) -> Tuple[Optional[int], Optional[int]]:
+    """ reads the width and height of a PNG image from its header, or (None, None) for other files
+    """
+    with open(path, 'rb') as f:
+        header = f.read(24)
+    if header[:8] != b'\x89PNG\r\n\x1a\n':
+        return None, None
+    return struct.unpack('>II', header[16:24])
+
+
+def to_figure(environment: str,
+              run_result_id: int,
+              proc_name: str,
+              title: str,
+              filename: str,
+              timestamp: Optional[float] = None) -> dict:
+    """ creates a figure record for a figure saved in the run folder
+    """
+    path = run_path(environment, run_result_id, filename)
+    width, height = png_size(path)
+    return {'id': None,
+            'run_result_id': run_result_id,
+            'proc_name': proc_name,
+            'title': title,
+            'filename': filename,
+            'size': os.path.getsize(path),
+            'width': width,
+            'height': height,
+            'timestamp': time.time() if timestamp is None else timestamp}
+
+
+def thumbnail_path(environment: str, run_result_id: int, filename: str = '') -> str:
+    """ gets the pathname of the folder for a run's figure thumbnails, optionally adding a filename
+    """
+    return os.path.join(run_path(environment, run_result_id, s.THUMBNAIL_DIR), filename)
+
+
+def make_thumbnail(environment: str, run_result_id: int, filename: str) -> Optional[str]:
+    """ creates a downsampled copy of a figure, if it doesn't exist already,
+        no larger than settings.THUMBNAIL_SIZE. returns its path, or None if
+        the figure isn't an image Pillow can read and write, such as an svg
+    """
+    path = thumbnail_path(environment, run_result_id, filename)
+    if not os.path.exists(path):
+        # Pillow is a dependency of matplotlib
+        from PIL import Image
+
+        create_dir_if_needed(thumbnail_path(environment, run_result_id))
+        # written under a temporary name and moved, so a request never gets half a file
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4())
+        try:
+            with Image.open(run_path(environment, run_result_id, filename)) as image:
+                image.thumbnail(s.THUMBNAIL_SIZE)
+                image.save(tmp_path, format=image.format)
+        except (OSError, ValueError) as error:
+            # Pillow's UnidentifiedImageError is an OSError
+            logging.warning("[simpyl logged] no thumbnail can be made of figure {}: {}".format(filename, error))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+        os.replace(tmp_path, path)
+    return path
+
+
+def find_figures(environment: str) -> List[dict]:
+    """ creates figure records for all the figures saved in an environment's run folders,
+        for environments made before figures were recorded in the database.
+        The procedure name and title are recovered from the filename,
+        which is ambiguous if the procedure name contains an underscore
+    """
+    figures = []
+    pattern = run_path(environment, '*', s.FIGURE_FORMAT.format('*', '*', '*'))
+    for path in sorted(glob.glob(pattern)):
+        run_folder, filename = os.path.split(path)
+        try:
+            run_result_id = int(os.path.basename(run_folder))
+        except ValueError:
+            continue
+        proc_name_title = os.path.splitext(filename)[0].rsplit('_', 1)[0]
+        proc_name, title = proc_name_title.split('_', 1)
+        figures += [to_figure(
+            environment, run_result_id, proc_name, title, filename, timestamp=os.path.getmtime(path)
+        )]
+    return figures
 
 
 def get_figures(environment: str, run_result_id: int) -> List[str]:
     """ gets a list of figures for a given run
     """
-    return [
-        os.path.basename(fname)
-        for fname in
-        glob.glob(run_path(environment, run_result_id, s.FIGURE_FORMAT.format("*", "*", "*")))
-    ]
+    return [figure['filename'] for figure in db.get_figures(environment, run_result_id)]
 
 
 def get_figure(environment: str, run_result_id: int, figure_name: str):
@@ -117,33 +544,274 @@ def get_figure(environment: str, run_result_id: int, figure_name: str):
     return open(run_path(environment, run_result_id, figure_name), 'rb')
 
 
-def write_cache(environment: str, filename: str, obj):
-    """ caches and object to file
-        If the filename ends with .csv and the object is a numpy array,
-        it is saved as a csv file
+_PICKLE5_MAGIC = b'SIMPYLP5'
+_PICKLE5_FOOTER_LENGTH = struct.Struct('<Q')
+
+
+def write_pickle5(path: str, obj):
+    """ pickles an object with protocol 5, writing large buffers such as numpy array data
+        out-of-band instead of copying them into the pickle stream.
+        The file holds a magic number, the pickle stream, each buffer starting at an aligned offset,
+        then a footer locating them all.
+        The file is written under a temporary name and moved into place rather than rewritten,
+        as arrays read from the old file are still mapped to it
     """
-    if filename[-4:] == '.csv' and type(obj) == np.ndarray:
-        np.savetxt(env_path(environment, filename), obj, delimiter=',')
+    buffers = []
+    payload = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4())
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(_PICKLE5_MAGIC)
+            layout = {'payload': (f.tell(), len(payload)), 'buffers': []}
+            f.write(payload)
+            for buffer in buffers:
+                raw = buffer.raw()
+                f.write(b'\0' * (-f.tell() % s.CACHE_BUFFER_ALIGNMENT))
+                layout['buffers'].append((f.tell(), raw.nbytes))
+                f.write(raw)
+            footer = pickle.dumps(layout, protocol=5)
+            f.write(footer)
+            f.write(_PICKLE5_FOOTER_LENGTH.pack(len(footer)))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def read_pickle5(path: str):
+    """ loads an object written by write_pickle5. The file is memory-mapped and the
+        out-of-band buffers are used in place, so arrays are read-only views of the file
+    """
+    with open(path, 'rb') as f:
+        mapped = mmap_module.mmap(f.fileno(), 0, access=mmap_module.ACCESS_READ)
+    if mapped[:len(_PICKLE5_MAGIC)] != _PICKLE5_MAGIC:
+        raise ValueError("{} is not a pickle protocol 5 cache file".format(path))
+    view = memoryview(mapped)
+    footer_end = len(mapped) - _PICKLE5_FOOTER_LENGTH.size
+    footer_length, = _PICKLE5_FOOTER_LENGTH.unpack(view[footer_end:])
+    layout = pickle.loads(view[footer_end - footer_length:footer_end])
+
+    offset, length = layout['payload']
+    return pickle.loads(
+        view[offset:offset + length],
+        buffers=[view[offset:offset + length] for offset, length in layout['buffers']]
+    )
+
+
+def open_compressed(path: str, mode: str, compression_level: int = s.CACHE_COMPRESSION_LEVEL):
+    """ opens a cache file, compressing it with zlib if the filename ends with .gz or lzma if
+        it ends with .xz. Data is compressed and decompressed a chunk at a time as it is
+        written and read
+    """
+    extension = os.path.splitext(path)[1]
+    if extension == '.gz':
+        if 'w' in mode:
+            return gzip.open(path, mode, compresslevel=compression_level)
+        return gzip.open(path, mode)
+    elif extension == '.xz':
+        if 'w' in mode:
+            return lzma.open(path, mode, preset=compression_level)
+        return lzma.open(path, mode)
+    return open(path, mode)
+
+
+class _ByteCounter(object):
+    """ a file-like object which only counts the bytes written to it
+    """
+
+    def __init__(self):
+        self.n_bytes = 0
+
+    def write(self, data) -> int:
+        n_bytes = memoryview(data).nbytes
+        self.n_bytes += n_bytes
+        return n_bytes
+
+
+def cache_object_size(filename: str, obj, file_size: int) -> int:
+    """ estimates the memory held by an object read from a cache file, to bound the in-memory cache.
+        This is the file's size, except for compressed files, which can be many times smaller than
+        the object. Their object's size is its pickled size, counted without holding the pickle in memory
+    """
+    if os.path.splitext(filename)[1] not in ['.gz', '.xz']:
+        return file_size
+    counter = _ByteCounter()
+    pickle.dump(obj, counter, protocol=5)
+    return counter.n_bytes
+
+
+def write_cache_iter(environment: str,
+                     filename: str,
+                     items: Iterable,
+                     compression_level: int = s.CACHE_COMPRESSION_LEVEL) -> int:
+    """ caches the items of an iterable to file one at a time, so the whole sequence is never in
+        memory. Use a .gz or .xz filename to compress the file. returns the number of items written
+    """
+    n_items = 0
+    with open_compressed(env_path(environment, filename), 'wb', compression_level) as f:
+        for item in items:
+            pickle.dump(item, f)
+            n_items += 1
+    logging.info("[simpyl logged] {} items of {} written to cache".format(n_items, filename))
+    return n_items
+
+
+def read_cache_iter(environment: str, filename: str) -> Iterator:
+    """ loads the items of a file written by write_cache_iter one at a time
+    """
+    with open_compressed(env_path(environment, filename), 'rb') as f:
+        # checking for more data first means a truncated file raises an error instead of ending early
+        while f.peek(1):
+            yield pickle.load(f)
+
+
+def write_cache(environment: str,
+                filename: str,
+                obj,
+                compression_level: int = s.CACHE_COMPRESSION_LEVEL):
+    """ caches and object to file. The format depends on the filename's extension
+        .csv: if the object is a numpy array, it is saved as a csv file
+        .npy: the object is saved as a numpy array in numpy's binary format
+        .npz: a dict of numpy arrays, or a single array, is saved in numpy's binary archive format
+        .pkl5: pickled with protocol 5, storing large buffers such as array data out-of-band
+        .gz or .xz: pickled and compressed with zlib or lzma at the given level
+        anything else is pickled
+    """
+    path = env_path(environment, filename)
+    extension = os.path.splitext(filename)[1]
+    if extension in ['.csv', '.npy', '.npz']:
+        import numpy as np
+
+    if extension == '.csv' and type(obj) == np.ndarray:
+        np.savetxt(path, obj, delimiter=',')
+    elif extension == '.npy':
+        # replaced rather than rewritten, as arrays read with mmap=True are still mapped to the old file
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4())
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.asanyarray(obj), allow_pickle=False)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    elif extension == '.npz':
+        if isinstance(obj, dict):
+            np.savez(path, **obj)
+        else:
+            np.savez(path, obj)
+    elif extension == '.pkl5':
+        write_pickle5(path, obj)
     else:
-        with open(env_path(environment, filename), 'wb') as f:
+        with open_compressed(path, 'wb', compression_level) as f:
             pickle.dump(obj, f)
 
     # update the database to register the cached file
     logging.info("[simpyl logged] {} written to cache".format(filename))
 
 
-def read_cache(environment: str, filename: str):
-    """ loads a file from the cache
-        If the filename ends with .csv, it will be opened as a csv file
+def cache_file_version(environment: str, filename: str) -> Tuple[int, int]:
+    """ gets the modification time and size of a cache file, which change whenever it is rewritten
+    """
+    stat = os.stat(env_path(environment, filename))
+    return stat.st_mtime_ns, stat.st_size
+
+
+def read_cache(environment: str, filename: str, mmap: bool = False):
+    """ loads a file from the cache, in the format given by the filename's extension
+        (see write_cache). .npz files are loaded as a dict of arrays
+
+        If mmap is True, a .npy file is returned as a read-only memory-mapped array,
+        which is paged in from disk as it is used instead of loaded all at once.
+        The arrays and other large buffers of .pkl5 files are always memory-mapped
     """
-    if filename[-4:] == '.csv':
-        obj = np.loadtxt(env_path(environment, filename), delimiter=',')
+    path = env_path(environment, filename)
+    extension = os.path.splitext(filename)[1]
+    if mmap and extension not in ['.npy', '.pkl5']:
+        raise ValueError("only .npy and .pkl5 files can be memory-mapped, not {}".format(filename))
+    if extension in ['.csv', '.npy', '.npz']:
+        import numpy as np
+
+    if extension == '.csv':
+        obj = np.loadtxt(path, delimiter=',')
+    elif extension == '.npy':
+        obj = np.load(path, mmap_mode='r' if mmap else None, allow_pickle=False)
+    elif extension == '.npz':
+        with np.load(path, allow_pickle=False) as npz:
+            obj = dict(npz)
+    elif extension == '.pkl5':
+        obj = read_pickle5(path)
     else:
-        with open(env_path(environment, filename), 'rb') as f:
+        with open_compressed(path, 'rb') as f:
             obj = pickle.load(f)
     return obj
 
 
+def _update_code_digest(digest, code: types.CodeType):
+    """ hashes a code object's bytecode and constants, including those of the functions, lambdas
+        and comprehensions nested in it. Only the contents are hashed, not reprs holding memory
+        addresses or set orders that differ between interpreters, so the key of a procedure is stable
+    """
+    digest.update(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _update_code_digest(digest, const)
+        elif isinstance(const, frozenset):
+            digest.update(repr(sorted(repr(item) for item in const)).encode())
+        else:
+            digest.update(repr(const).encode())
+
+
+def memo_key(proc_name: str, fn, kwargs: dict) -> Optional[str]:
+    """ hashes a procedure's source, bytecode and arguments into a key for its memoized result.
+        returns None if the arguments can't be pickled, in which case the call isn't memoized
+    """
+    digest = hashlib.sha256(proc_name.encode())
+    try:
+        digest.update(inspect.getsource(fn).encode())
+    except (OSError, TypeError):
+        pass
+    _update_code_digest(digest, fn.__code__)
+    try:
+        digest.update(pickle.dumps(sorted(kwargs.items()), protocol=4))
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+    return digest.hexdigest()
+
+
+def memo_path(environment: str, key: str) -> str:
+    """ gets the pathname of a memoized result. The results are stored by key in the environment
+    """
+    return env_path(environment, os.path.join(s.MEMO_DIR, key[:2], key + '.pkl'))
+
+
+def read_memo(environment: str, key: str) -> Tuple[bool, object]:
+    """ loads a memoized result, returning (False, None) if there isn't one
+    """
+    try:
+        with open(memo_path(environment, key), 'rb') as f:
+            return True, pickle.load(f)
+    except FileNotFoundError:
+        return False, None
+
+
+def write_memo(environment: str, key: str, obj) -> bool:
+    """ stores a memoized result, returning False if it can't be pickled.
+        The file is written under a temporary name and moved into place,
+        so a concurrent read never sees part of a result
+    """
+    path = memo_path(environment, key)
+    create_dir_if_needed(os.path.dirname(path))
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4())
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(obj, f)
+        os.replace(tmp_path, path)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        os.remove(tmp_path)
+        return False
+    return True
+
+
 def reset_environment(environment: str):
     """ creates all the necessary directories and database entries for a new environment
     """
@@ -185,6 +853,182 @@ def to_proc_inits(procs: List[Tuple]) -> List[dict]:
             for i, p in enumerate(procs)]
 
 
+def to_proc_dependencies(depends_on: Optional[Iterable[str]],
+                         reads: Optional[Iterable[str]],
+                         writes: Optional[Iterable[str]]) -> Optional[dict]:
+    """ creates the dependency declaration of a procedure, or None for a procedure which
+        declares nothing
+    """
+    if depends_on is None and reads is None and writes is None:
+        return None
+    return {'depends_on': set(depends_on or []),
+            'reads': set(reads or []),
+            'writes': set(writes or [])}
+
+
+def to_proc_graph(proc_inits: List[dict], dependencies: dict) -> List[set]:
+    """ works out which procedures of a run must finish before each one starts.
+        dependencies maps procedure names to their to_proc_dependencies declaration.
+        returns the set of indices in proc_inits that each procedure waits for
+
+        A procedure waits for an earlier one if it names it in depends_on, reads a cache key
+        the earlier one writes, or writes a cache key the earlier one reads or writes.
+        A procedure without a declaration waits for all earlier procedures and all later ones
+        wait for it, so it runs alone in list order. Procedures only ever wait for earlier ones,
+        so the list order is always a valid order to run them in
+    """
+    graph = []
+    for j, proc_init in enumerate(proc_inits):
+        declared = dependencies.get(proc_init['proc_name'])
+        predecessors = set()
+        for i in range(j):
+            earlier = dependencies.get(proc_inits[i]['proc_name'])
+            if (declared is None or earlier is None or
+                    proc_inits[i]['proc_name'] in declared['depends_on'] or
+                    earlier['writes'] & declared['reads'] or
+                    declared['writes'] & (earlier['reads'] | earlier['writes'])):
+                predecessors.add(i)
+        graph.append(predecessors)
+    return graph
+
+
+def _sample_argument(rng: random.Random, values):
+    """ draws a value for a random search from a list of values or a distribution
+    """
+    if isinstance(values, list):
+        return rng.choice(values)
+    (name, (low, high)), = values.items()
+    if name == 'uniform':
+        return rng.uniform(low, high)
+    elif name == 'loguniform':
+        return math.exp(rng.uniform(math.log(low), math.log(high)))
+    return rng.randint(low, high)
+
+
+def _check_sweep_grid(procs: List[Tuple], grid: dict, random_search: bool):
+    proc_names = set(proc_name for proc_name, _ in procs)
+    for proc_name, arguments in grid.items():
+        if proc_name not in proc_names:
+            raise ValueError("{} is swept but isn't one of the run's procedures".format(proc_name))
+        for argument, values in arguments.items():
+            if isinstance(values, list) and values:
+                continue
+            if not (isinstance(values, dict) and len(values) == 1 and
+                    list(values)[0] in s.SWEEP_DISTRIBUTIONS and len(list(values.values())[0]) == 2):
+                raise ValueError(
+                    "{}.{} must be a list of values or one of {} with [low, high]".format(
+                        proc_name, argument, s.SWEEP_DISTRIBUTIONS)
+                )
+            if not random_search:
+                raise ValueError("{}.{} is a distribution, so n_samples must be set".format(proc_name, argument))
+
+
+def expand_sweep(procs: List[Tuple],
+                 grid: dict,
+                 n_samples: Optional[int] = None,
+                 seed: Optional[int] = None) -> List[Tuple[dict, List[Tuple]]]:
+    """ expands a sweep over the arguments of a list of (proc_name, arguments) tuples.
+        grid maps procedure names to {argument: values}, where values is a list of values
+        or, for a random search, a distribution {'uniform' | 'loguniform' | 'randint': [low, high]}
+
+        Without n_samples every combination of the listed values is made. With n_samples,
+        that many combinations are drawn at random: distinct combinations from the grid if all
+        the values are lists, and otherwise each argument is drawn independently.
+        returns a list of (params, procs) for each run, where params maps 'proc_name.argument'
+        to the value used and procs has the arguments of the swept procedures replaced
+    """
+    _check_sweep_grid(procs, grid, n_samples is not None)
+    keys = [(proc_name, argument) for proc_name in grid for argument in grid[proc_name]]
+    values = [grid[proc_name][argument] for proc_name, argument in keys]
+
+    if n_samples is None:
+        combinations = list(itertools.product(*values))
+    else:
+        rng = random.Random(seed)
+        if all(isinstance(v, list) for v in values):
+            # pick distinct combinations by index, without listing the whole grid
+            n_combinations = math.prod(len(v) for v in values)
+            combinations = []
+            for index in rng.sample(range(n_combinations), min(n_samples, n_combinations)):
+                combination = []
+                for v in reversed(values):
+                    index, i = divmod(index, len(v))
+                    combination.append(v[i])
+                combinations.append(tuple(reversed(combination)))
+        else:
+            combinations = [tuple(_sample_argument(rng, v) for v in values) for _ in range(n_samples)]
+
+    sweep_runs = []
+    for combination in combinations:
+        params = dict(('{}.{}'.format(*key), value) for key, value in zip(keys, combination))
+        overrides = {}
+        for (proc_name, argument), value in zip(keys, combination):
+            overrides.setdefault(proc_name, {})[argument] = value
+        sweep_runs.append(
+            (params, [(proc_name, dict(arguments, **overrides.get(proc_name, {}))) for proc_name, arguments in procs])
+        )
+    return sweep_runs
+
+
+def to_sweep(environment: str, description: str, spec: dict) -> dict:
+    """ creates a sweep template
+    """
+    return {'id': None,
+            'description': description,
+            'timestamp': time.time(),
+            'environment': environment,
+            'spec': spec}
+
+
+def summarise_sweep(sweep: dict) -> dict:
+    """ adds a summary of a sweep's runs: the number of runs with each status, and a row per
+        run with the swept arguments, the result of each procedure and the run's duration
+    """
+    status_counts = {}
+    rows = []
+    for run_result in sweep['run_results']:
+        status_counts[run_result['status']] = status_counts.get(run_result['status'], 0) + 1
+        duration = None
+        if run_result['timestamp_start'] is not None and run_result['timestamp_stop'] is not None:
+            duration = run_result['timestamp_stop'] - run_result['timestamp_start']
+        rows.append({'run_result_id': run_result['id'],
+                     'status': run_result['status'],
+                     'duration': duration,
+                     'params': run_result['sweep_params'],
+                     'results': dict((p['proc_name'], p['result']) for p in run_result['proc_results'])})
+    sweep['status_counts'] = status_counts
+    sweep['rows'] = rows
+    return sweep
+
+
+def dump_run_init(run_init: dict) -> Optional[bytes]:
+    """ pickles a run_init to be stored with its run, or returns None if its arguments can't be
+        pickled, in which case the run can't be resumed
+    """
+    try:
+        return pickle.dumps(run_init, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        logging.warning("[simpyl logged] the arguments of run {} can't be stored, so it can't be resumed".format(
+            run_init['description']
+        ))
+        return None
+
+
+def to_resumed_run_init(run_init: dict, run_result: dict) -> dict:
+    """ creates the run_init to resume a failed run from the run_init it was started with.
+        Procedures which completed in the failed run are skipped and their results reused
+    """
+    return dict(
+        run_init,
+        description="resume of #{}: {}".format(run_result['id'], run_result['description']),
+        resumed_from=run_result['id'],
+        reused_results=dict(
+            (proc_result['run_order'], proc_result) for proc_result in run_result['proc_results']
+            if proc_result['status'] in s.REUSABLE_STATUSES
+        )
+    )
+
+
 def to_run_result(run_init: dict) -> dict:
     """ creates a run_result template from a run_init
     """
@@ -194,6 +1038,10 @@ def to_run_result(run_init: dict) -> dict:
             'status': 'pending',
             'description': run_init['description'],
             'environment': run_init['environment'],
+            'sweep_id': None,
+            'sweep_params': None,
+            'traceback': None,
+            'resumed_from': run_init.get('resumed_from'),
             'proc_results': []}
 
 
@@ -206,19 +1054,61 @@ def to_proc_result(proc_init: dict) -> dict:
             'timestamp_start': None,
             'timestamp_stop': None,
             'result': None,
+            'status': None,
+            'profile': None,
+            'cpu_user': None,
+            'cpu_system': None,
+            'max_rss_delta': None,
+            'io_read_bytes': None,
+            'io_write_bytes': None,
+            'cache_bytes_read': None,
+            'cache_bytes_written': None,
             'arguments': proc_init['arguments'],
             'arguments_str': proc_init['arguments_str'],
             'run_result_id': None}
 
 
-def to_run_init(environment: str, procs: List[Tuple], description: str) -> dict:
+def to_run_state(environment: Optional[str], run_result_id: int, logger: logging.Logger) -> dict:
+    """ creates the state a Simpyl object keeps for the run in the current context
+    """
+    return {'environment': environment,
+            'run_result_id': run_result_id,
+            'proc_name': '',
+            'logger': logger,
+            'pending_figures': [],
+            'cache_bytes_read': 0,
+            'cache_bytes_written': 0,
+            'write_session': None}
+
+
+def to_worker_status(worker_id: int, worker_type: str) -> dict:
+    """ creates a worker status template for a queue worker
+    """
+    return {'worker_id': worker_id,
+            'name': 'simpyl-worker-{}'.format(worker_id),
+            'worker_type': worker_type,
+            'pid': None,
+            'status': 'idle',
+            'run_result_id': None,
+            'runs_completed': 0}
+
+
+def to_run_init(environment: str,
+                procs: List[Tuple],
+                description: str,
+                profile: bool = False,
+                trace_memory: bool = False,
+                max_parallel: int = s.DEFAULT_PROC_WORKERS) -> dict:
     """ takes a list of (proc_name, arguments) tuples and converts them to a
         a correctly formatted run_init
     """
     return {
         'description': description,
         'environment': environment,
-        'proc_inits': to_proc_inits(procs)
+        'proc_inits': to_proc_inits(procs),
+        'profile': profile,
+        'trace_memory': trace_memory,
+        'max_parallel': max_parallel
     }
 
 
@@ -228,3 +1118,10 @@ register_proc_result = db.register_proc_result
 update_run_result = db.update_run_result
 get_run_results = db.get_run_results
 get_single_run_result = db.get_single_run_result
+migrate_database = db.migrate_database
+register_figure = db.register_figure
+register_sweep = db.register_sweep
+register_run_init = db.register_run_init
+get_run_init = db.get_run_init
+WriteSession = db.WriteSession
+get_sweep = db.get_sweep
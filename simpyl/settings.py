@@ -1,7 +1,63 @@
 import os
 
 LOGFILE_FORMAT = 'run_{}.log'
+# most bytes of a log returned per request when tailing it
+LOG_CHUNK_BYTES = 2 ** 20
+# seconds between checks for new log lines when streaming a log
+LOG_POLL_INTERVAL = 0.5
+# log records waiting to be written to a run's log file. When the queue is full, LOG_OVERFLOW 'block'
+# makes the procedure wait for the writer and 'drop' discards the record
+LOG_QUEUE_SIZE = 10000
+LOG_OVERFLOW = 'block'
+# longest time in seconds a written log record may wait before the file is flushed
+LOG_FLUSH_INTERVAL = 0.2
 DESCRIPTION_FORMAT = 'run_{}_description.txt'
 FIGURE_FORMAT = '{}_{}_{}.png'
+# seconds browsers may cache a figure for
+FIGURE_MAX_AGE = 365 * 24 * 60 * 60
+PROFILE_FORMAT = 'profile_{}_{}.prof'
+MEMORY_REPORT_FORMAT = 'memory_{}_{}.txt'
+# functions and allocation sites listed in a procedure's profile summary
+PROFILE_TOP_N = 20
+# threads rendering figures in the background. 0 renders them in Simpyl.savefig instead
+FIGURE_WORKERS = 2
+THUMBNAIL_DIR = 'thumbs'
+# largest width and height of figure thumbnails, in pixels
+THUMBNAIL_SIZE = (320, 240)
 DB_FILENAME = 'simpyl.db'
+MEMO_DIR = 'memo'
+# total size of the cache files kept in memory by Simpyl.read_cache
+CACHE_MAX_BYTES = 2 ** 30
+# byte alignment of the out-of-band buffers in .pkl5 cache files, enough for any numpy dtype
+CACHE_BUFFER_ALIGNMENT = 64
+# zlib (.gz) or lzma (.xz) level for compressed cache files, from 0 (fastest) to 9 (smallest)
+CACHE_COMPRESSION_LEVEL = 6
+DB_TIMEOUT = 30.0
+# longest time in seconds a run's buffered result writes may wait before they are committed
+DB_FLUSH_INTERVAL = 1.0
+# WAL lets the webserver read while a worker writes. synchronous=NORMAL only syncs
+# at checkpoints, which is safe in WAL mode
+DB_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA temp_store=MEMORY',
+)
 DEFAULT_ENV_DIR = os.path.join('envs', 'default')
+DEFAULT_MAX_WORKERS = 1
+WORKER_TYPES = ('thread', 'process')
+DEFAULT_WORKER_TYPE = 'thread'
+# modules imported by process workers when they start, so runs don't pay the import cost
+PRELOAD_MODULES = ('numpy', 'matplotlib.pyplot')
+# threads running the independent procedures of a run at the same time
+DEFAULT_PROC_WORKERS = 4
+# queue workers a sweep starts if fewer are running
+DEFAULT_SWEEP_WORKERS = 4
+# statuses of runs which haven't finished. A run's log is complete once it has any other status
+UNFINISHED_STATUSES = ('pending', 'running')
+# statuses of procedures whose results a resumed run reuses instead of calling them again
+REUSABLE_STATUSES = ('complete', 'cached', 'reused')
+# distributions a random search can sample an argument from, as {name: [low, high]}
+SWEEP_DISTRIBUTIONS = ('uniform', 'loguniform', 'randint')
+RUNS_PAGE_SIZE = 100
+RUNS_MAX_PAGE_SIZE = 1000
@@ -1,29 +1,96 @@
+import concurrent.futures
+import contextvars
+import functools
+import importlib
 import inspect
+import multiprocessing
+import os
+import pickle
 import time
 import queue
+import random
 import threading
-from typing import List
+import traceback
+from typing import List, Optional, Sequence
 
 import simpyl.run_manager as runm
+import simpyl.settings as s
+from simpyl.cache import LRUCache
+
+
+class _ProcedureFailed(Exception):
+    """ raised from the error of a procedure, carrying its failed proc_result
+    """
+
+    def __init__(self, proc_result: dict):
+        super().__init__(proc_result['proc_name'])
+        self.proc_result = proc_result
 
 
 class Simpyl(object):
-    def __init__(self):
+    def __init__(self, cache_max_bytes: int = s.CACHE_MAX_BYTES):
         # constant variables
         self._procedures = {}
         self._proc_inits = []
+        self._memoized = set()
+        self._dependencies = {}
         # manually updated state
         self._current_env = ''
-        # updated and reset each run
-        self._current_run = -1
-        self._current_proc = ''
-        self._logger = runm.stream_logger()
+        # updated and reset each run. The state is context-local, so runs in different
+        # threads or tasks each see their own run
+        self._default_state = runm.to_run_state(None, -1, runm.stream_logger())
+        self._run_state = contextvars.ContextVar('simpyl_run_state', default=None)
         self._queue = queue.Queue()
+        self._workers = []
+        # set by the first call to start_queue. Sweeps only add workers to a queue of thread workers
+        self._worker_type = None
+        # objects recently read from cache files, shared by all runs in this process
+        self._cache = LRUCache(cache_max_bytes)
+        # threads which render figures, started in each process when first needed
+        self._figure_pool = None
+        self._figure_pool_pid = None
+        self._figure_pool_lock = threading.Lock()
+        # set in process workers, where results are sent back to the parent process
+        self._send_event = None
+
+    def _get_state(self) -> dict:
+        state = self._run_state.get()
+        return self._default_state if state is None else state
+
+    @property
+    def _current_run(self) -> int:
+        return self._get_state()['run_result_id']
+
+    @property
+    def _current_proc(self) -> str:
+        return self._get_state()['proc_name']
+
+    @property
+    def _logger(self):
+        return self._get_state()['logger']
+
+    @property
+    def _run_env(self) -> str:
+        """ the environment of the current run, or the current environment outside a run
+        """
+        environment = self._get_state()['environment']
+        return self._current_env if environment is None else environment
 
     def reset_state(self):
-        self._current_run = -1
-        self._current_proc = ''
-        self._logger = runm.stream_logger()
+        self._run_state.set(None)
+
+    def wrap_context(self, fn):
+        """ wraps fn so it is called with the run state of the caller. Use this for
+            functions a procedure hands to threads or executors, so that logs,
+            figures and cache files go to the right run
+        """
+        ctx = contextvars.copy_context()
+
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            return ctx.copy().run(fn, *args, **kwargs)
+
+        return wrapped
 
     def reset_environment(self, environment: str):
         """ creates all the necessary directories and database entries for a new environment
@@ -33,25 +100,46 @@ class Simpyl(object):
         self._current_env = environment
 
     def use_environment(self, environment: str):
-        # TODO: check file structure and DB is set correctly
+        """ sets the current environment state, upgrading its database to the latest schema
+        """
+        # TODO: check file structure is set correctly
+        runm.migrate_database(environment)
         self._current_env = environment
 
     def get_environment(self) -> str:
         return self._current_env
 
-    def set_run(self, run_result_id: int, description: str):
+    def set_run(self, run_result_id: int, description: str, environment: str = None):
         """ creates all the necessary directories and sets up the Simpyl object for a run
-            and sets the current run state
+            and sets the current run state. The environment defaults to the current environment
         """
-        runm.set_run(self._current_env, run_result_id, description)
-        self._current_run = run_result_id
-        # set up logging to log to a file
-        self._logger = runm.run_logger(self._current_env, run_result_id)
+        if environment is None:
+            environment = self._current_env
+        runm.set_run(environment, run_result_id, description)
+        # set up logging to log to a file, or to the parent process in a process worker
+        if self._send_event is None:
+            logger = runm.run_logger(environment, run_result_id)
+        else:
+            logger = runm.event_logger(self._send_event, run_result_id)
+        state = runm.to_run_state(environment, run_result_id, logger)
+        if self._send_event is None:
+            # results are committed a few at a time, as committing each one can take longer than the procedure
+            state['write_session'] = runm.WriteSession(environment)
+        self._run_state.set(state)
 
     def set_proc(self, proc_name: str):
-        """ sets the current proc state
+        """ sets the current proc state, with its cache byte counts starting from zero
         """
-        self._current_proc = proc_name
+        self._run_state.set(dict(
+            self._get_state(), proc_name=proc_name, pending_figures=[], cache_bytes_read=0, cache_bytes_written=0
+        ))
+
+    def _count_cache_bytes(self, key: str, n_bytes: int):
+        """ adds to the cache bytes read or written by the current procedure
+        """
+        state = self._run_state.get()
+        if state is not None:
+            state[key] += n_bytes
 
     def log(self, text: str):
         """ logs some information
@@ -63,41 +151,162 @@ class Simpyl(object):
         """
         return runm.get_log(self._current_env, run_result_id)
 
-    def savefig(self, title: str, *args, **kwargs):
+    def read_log(self, run_result_id: int, offset: int = 0, max_bytes: Optional[int] = s.LOG_CHUNK_BYTES):
+        """ Returns the log lines written after the byte offset, and the offset to read from next
+        """
+        return runm.read_log(self._current_env, run_result_id, offset, max_bytes)
+
+    def savefig(self, title: str, *args, fig=None, **kwargs):
         """ saves a figure to the run folder. *args and **kwargs are passed to the
             matplotlib.savefig function
+
+            fig defaults to pyplot's current figure, which is taken out of pyplot so the
+            procedure can go on drawing. The figure is rendered and saved on a background
+            thread; procedures running at the same time as others should pass a Figure
+            they created themselves, rather than using pyplot. flush_figures waits for
+            the figures to be saved, and is called when each procedure returns
+        """
+        if fig is None:
+            fig = runm.detach_current_figure()
+        figure_pool = self._get_figure_pool()
+        if figure_pool is None:
+            self._savefig(title, fig, args, kwargs)
+        else:
+            self._get_state()['pending_figures'].append(
+                figure_pool.submit(self.wrap_context(self._savefig), title, fig, args, kwargs)
+            )
+
+    def flush_figures(self):
+        """ waits until the figures passed to savefig by the current run have been saved,
+            raising any error from saving them
         """
-        runm.savefig(
-            self._current_env, self._current_run, self._current_proc,
-            title, *args, **kwargs
+        pending = self._get_state()['pending_figures']
+        while pending:
+            pending.pop(0).result()
+
+    def _get_figure_pool(self) -> Optional[concurrent.futures.ThreadPoolExecutor]:
+        if s.FIGURE_WORKERS < 1:
+            return None
+        with self._figure_pool_lock:
+            # threads don't survive a fork, so process workers start their own pool
+            if self._figure_pool_pid != os.getpid():
+                self._figure_pool = concurrent.futures.ThreadPoolExecutor(
+                    s.FIGURE_WORKERS, thread_name_prefix='simpyl-figure'
+                )
+                self._figure_pool_pid = os.getpid()
+            return self._figure_pool
+
+    def _savefig(self, title: str, fig, args, kwargs):
+        figure = runm.savefig(
+            self._run_env, self._current_run, self._current_proc,
+            title, *args, fig=fig, **kwargs
         )
+        # a figure without a thumbnail is still saved, and is shown full size
+        runm.make_thumbnail(self._run_env, self._current_run, figure['filename'])
+        if self._send_event is None:
+            runm.register_figure(self._run_env, figure)
+        else:
+            self._send_event(('register_figure', figure))
 
     def get_figures(self, run_result_id: int) -> List[str]:
         return runm.get_figures(self._current_env, run_result_id)
 
+    def get_run_path(self, run_result_id: int) -> str:
+        """ gets the folder where a run's log and figures are saved
+        """
+        return runm.run_path(self._current_env, run_result_id)
+
+    def get_thumbnail_path(self, run_result_id: int, figure_name: str) -> Optional[str]:
+        """ gets the path of a figure's thumbnail, creating it for figures saved without one.
+            None if no thumbnail can be made of the figure
+        """
+        return runm.make_thumbnail(self._current_env, run_result_id, figure_name)
+
     def get_figure(self, run_result_id: int, figure_name: str):
         return runm.get_figure(self._current_env, run_result_id, figure_name)
 
-    def get_run_results(self) -> List[dict]:
-        return runm.get_run_results(self._current_env)
+    def get_run_results(self,
+                        after_id: Optional[int] = None,
+                        limit: Optional[int] = None,
+                        order: str = 'asc') -> List[dict]:
+        return runm.get_run_results(self._current_env, after_id=after_id, limit=limit, order=order)
 
     def get_single_run_result(self, run_result_id: int) -> dict:
         return runm.get_single_run_result(self._current_env, run_result_id)
 
-    def read_cache(self, filename):
-        """ loads a file from the cache.
-            calls run_manager.read_cache
+    def get_sweep(self, sweep_id: int) -> Optional[dict]:
+        """ gets a sweep with its runs and a summary of their results (see run_manager.summarise_sweep)
         """
-        return runm.read_cache(self._current_env, filename)
+        sweep = runm.get_sweep(self._current_env, sweep_id)
+        return None if sweep is None else runm.summarise_sweep(sweep)
 
-    def write_cache(self, obj, filename):
+    def read_cache(self, filename, mmap: bool = False):
+        """ loads a file from the cache.
+            calls run_manager.read_cache, unless the file is unchanged since it was last read
+            and is still held in memory. The same object is then returned again,
+            so don't modify objects read from the cache in place
+
+            memory-mapped reads aren't held in memory as they are cheap to repeat
+        """
+        version = runm.cache_file_version(self._run_env, filename)
+        if mmap:
+            self._count_cache_bytes('cache_bytes_read', version[1])
+            return runm.read_cache(self._run_env, filename, mmap=True)
+        key = (self._run_env, filename)
+        hit, obj = self._cache.get(key, version)
+        if not hit:
+            self._count_cache_bytes('cache_bytes_read', version[1])
+            obj = runm.read_cache(self._run_env, filename)
+            self._cache.put(key, version, obj, runm.cache_object_size(filename, obj, version[1]))
+        return obj
+
+    def write_cache(self, obj, filename, compression_level: int = s.CACHE_COMPRESSION_LEVEL):
         """ caches and object to file.
             calls run_manager.write_cache
         """
-        return runm.write_cache(self._current_env, filename, obj)
+        self._cache.invalidate((self._run_env, filename))
+        runm.write_cache(self._run_env, filename, obj, compression_level)
+        self._count_cache_bytes('cache_bytes_written', runm.cache_file_version(self._run_env, filename)[1])
+
+    def write_cache_iter(self, items, filename, compression_level: int = s.CACHE_COMPRESSION_LEVEL) -> int:
+        """ caches the items of an iterable to file one at a time, for datasets larger than memory.
+            calls run_manager.write_cache_iter
+        """
+        self._cache.invalidate((self._run_env, filename))
+        n_items = runm.write_cache_iter(self._run_env, filename, items, compression_level)
+        self._count_cache_bytes('cache_bytes_written', runm.cache_file_version(self._run_env, filename)[1])
+        return n_items
+
+    def read_cache_iter(self, filename):
+        """ loads the items of a file written by write_cache_iter one at a time.
+            calls run_manager.read_cache_iter
+        """
+        self._count_cache_bytes('cache_bytes_read', runm.cache_file_version(self._run_env, filename)[1])
+        return runm.read_cache_iter(self._run_env, filename)
 
-    def add_procedure(self, procedure_name):
+    def get_cache_stats(self) -> dict:
+        """ returns the hit, miss and eviction counts of the in-memory cache of this process
+        """
+        return self._cache.get_stats()
+
+    def add_procedure(self,
+                      procedure_name,
+                      memoize: bool = False,
+                      depends_on: Optional[Sequence[str]] = None,
+                      reads: Optional[Sequence[str]] = None,
+                      writes: Optional[Sequence[str]] = None):
         """ registers a procedure with the Simpyl object
+
+            If memoize is True, return values are stored in the environment keyed on the
+            procedure's code and arguments. A later call with the same code and arguments
+            returns the stored value without calling the procedure, so only memoize procedures
+            whose effects are all in their return value
+
+            depends_on names the procedures that must finish before this one starts, and reads
+            and writes list the cache files it reads and writes. A procedure declaring any of
+            these runs at the same time as the other procedures of its run that it doesn't
+            depend on (see run_manager.to_proc_graph). Procedures declaring none of them run
+            one at a time in list order
         """
 
         def decorator(fn):
@@ -112,6 +321,9 @@ class Simpyl(object):
 
             if procedure_name not in self._procedures:
                 self._procedures[procedure_name] = fn
+                if memoize:
+                    self._memoized.add(procedure_name)
+                self._dependencies[procedure_name] = runm.to_proc_dependencies(depends_on, reads, writes)
                 # TODO: remove arguments_str key?
                 self._proc_inits += [{'proc_name': procedure_name,
                                       'run_order': None,
@@ -125,7 +337,26 @@ class Simpyl(object):
         return self._proc_inits
 
     def _perform_run(self, run_init, run_result, convert_args_to_numbers):
-        self.set_run(run_result['id'], run_result['description'])
+        # the run state is set in a copy of the caller's context, so it never leaks out of the run
+        return contextvars.copy_context().run(
+            self._perform_run_in_context, run_init, run_result, convert_args_to_numbers
+        )
+
+    def _perform_run_in_context(self, run_init, run_result, convert_args_to_numbers):
+        self.set_run(run_result['id'], run_result['description'], run_result['environment'])
+        try:
+            self._run_procedures(run_init, run_result, convert_args_to_numbers)
+        finally:
+            try:
+                if self._get_state()['write_session'] is not None:
+                    self._get_state()['write_session'].close()
+            finally:
+                # the log file is closed once the writes queued by the run are done
+                runm.close_logger(self._logger)
+                self.reset_state()
+        return run_result
+
+    def _run_procedures(self, run_init, run_result, convert_args_to_numbers):
         self._logger.info(
             "[simpyl logged] run #{} started with environment {}".format(
                 run_result['id'], run_result['environment']
@@ -133,56 +364,361 @@ class Simpyl(object):
         )
         run_result['timestamp_start'] = time.time()
         run_result['status'] = 'running'
-        runm.update_run_result(self._current_env, run_result)
-
-        # call all the procedures
-        for run_order, proc_init in enumerate(run_init['proc_inits']):
-            # run the procedure
-            proc_result = runm.to_proc_result(proc_init)
-            # set the run order
-            proc_result['run_order'] = run_order
-
-            proc_result['run_result_id'] = run_result['id']
-            self.set_proc(proc_init['proc_name'])
-
-            # work out the arguments, converting stings to numbers if applicable
-            if convert_args_to_numbers:
-                kwargs = dict(
-                    (kw, runm.to_number(value))
-                    for kw, value in [(arg['name'], arg['value']) for arg in proc_init['arguments']]
-                )
+        self._register_run_init(run_result, run_init, convert_args_to_numbers)
+        self._update_run_result(run_result)
+
+        # call all the procedures, in list order unless they declare their dependencies
+        proc_inits = run_init['proc_inits']
+        graph = runm.to_proc_graph(proc_inits, self._dependencies)
+        max_parallel = run_init.get('max_parallel', s.DEFAULT_PROC_WORKERS)
+        try:
+            if max_parallel > 1 and any(predecessors != set(range(j)) for j, predecessors in enumerate(graph)):
+                self._run_procedure_graph(run_init, run_result, graph, max_parallel, convert_args_to_numbers)
             else:
-                kwargs = dict(
-                    (kw, value)
-                    for kw, value in [(arg['name'], arg['value']) for arg in proc_init['arguments']]
-                )
+                for run_order in range(len(proc_inits)):
+                    self._add_proc_result(
+                        run_result, self._run_procedure(run_init, run_result, run_order, convert_args_to_numbers)
+                    )
+        except _ProcedureFailed as failed:
+            self._add_proc_result(run_result, failed.proc_result)
+            run_result['proc_results'].sort(key=lambda proc_result: proc_result['run_order'])
+            error = failed.__cause__
+            self._record_failure(
+                run_result, ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+            )
+            # the procedure's own error is raised to the caller
+            raise error from None
+        except Exception:
+            self._record_failure(run_result, traceback.format_exc())
+            raise
+
+        # register the run result
+        run_result['timestamp_stop'] = time.time()
+        run_result['status'] = 'complete'
+        self._update_run_result(run_result)
+
+    def _run_procedure_graph(self, run_init, run_result, graph, max_parallel, convert_args_to_numbers):
+        """ calls the procedures of a run on a thread pool, each once those it waits for in graph
+            have finished. Results are registered from this thread as procedures finish
+        """
+        waiting = dict((j, set(predecessors)) for j, predecessors in enumerate(graph))
+        running = {}
+        error = None
+        with concurrent.futures.ThreadPoolExecutor(
+                max_parallel, thread_name_prefix='simpyl-run-{}'.format(run_result['id'])) as pool:
+            while waiting or running:
+                # after an error nothing new is started, but running procedures are waited for
+                if error is None:
+                    for run_order in [j for j, predecessors in waiting.items() if not predecessors]:
+                        del waiting[run_order]
+                        # each procedure gets a copy of the run's context, so set_proc doesn't affect the others
+                        future = pool.submit(
+                            contextvars.copy_context().run, self._run_procedure,
+                            run_init, run_result, run_order, convert_args_to_numbers
+                        )
+                        running[future] = run_order
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    run_order = running.pop(future)
+                    if future.exception() is not None:
+                        if error is None:
+                            error = future.exception()
+                        elif isinstance(future.exception(), _ProcedureFailed):
+                            # only the first error is raised, but every failed procedure is recorded
+                            self._add_proc_result(run_result, future.exception().proc_result)
+                        continue
+                    self._add_proc_result(run_result, future.result())
+                    for predecessors in waiting.values():
+                        predecessors.discard(run_order)
+        run_result['proc_results'].sort(key=lambda proc_result: proc_result['run_order'])
+        if error is not None:
+            raise error
+
+    def _add_proc_result(self, run_result: dict, proc_result: dict):
+        self._register_proc_result(proc_result)
+        run_result['proc_results'] += [proc_result]
+        # between procedures, commit the results buffered for longer than the flush interval
+        write_session = self._get_state()['write_session']
+        if write_session is not None:
+            write_session.flush_if_due()
+
+    def _run_procedure(self, run_init, run_result, run_order, convert_args_to_numbers) -> dict:
+        """ calls the procedure at run_order in the run, returning its proc_result
+        """
+        proc_init = run_init['proc_inits'][run_order]
+        proc_result = runm.to_proc_result(proc_init)
+        # set the run order
+        proc_result['run_order'] = run_order
+
+        proc_result['run_result_id'] = run_result['id']
+        self.set_proc(proc_init['proc_name'])
 
+        reused = run_init.get('reused_results', {}).get(run_order)
+        if reused is not None:
             self._logger.info(
-                "[simpyl logged] Procedure {} called with arguments {}".format(
-                    proc_init['proc_name'], kwargs
+                "[simpyl logged] Procedure {} reused from run #{}".format(
+                    proc_init['proc_name'], reused['run_result_id']
                 )
             )
-            proc_result['timestamp_start'] = time.time()
-            results = self._procedures[proc_init['proc_name']](**kwargs)
+            proc_result['timestamp_start'] = proc_result['timestamp_stop'] = time.time()
+            proc_result['result'] = reused['result']
+            proc_result['status'] = 'reused'
+            return proc_result
+
+        # work out the arguments, converting stings to numbers if applicable
+        if convert_args_to_numbers:
+            kwargs = dict(
+                (kw, runm.to_number(value))
+                for kw, value in [(arg['name'], arg['value']) for arg in proc_init['arguments']]
+            )
+        else:
+            kwargs = dict(
+                (kw, value)
+                for kw, value in [(arg['name'], arg['value']) for arg in proc_init['arguments']]
+            )
+
+        self._logger.info(
+            "[simpyl logged] Procedure {} called with arguments {}".format(
+                proc_init['proc_name'], kwargs
+            )
+        )
+        proc_result['timestamp_start'] = time.time()
+        usage_before = runm.resource_usage()
+        try:
+            if run_init.get('profile') or run_init.get('trace_memory'):
+                (results, proc_result['status']), proc_result['profile'] = runm.profile_call(
+                    self._run_env, run_result['id'], run_order, proc_init['proc_name'],
+                    bool(run_init.get('trace_memory')), self._call_procedure, proc_init['proc_name'], kwargs
+                )
+            else:
+                results, proc_result['status'] = self._call_procedure(proc_init['proc_name'], kwargs)
+            self.flush_figures()
+        except Exception as error:
             proc_result['timestamp_stop'] = time.time()
-            proc_result['result'] = str(results)
+            proc_result['status'] = 'failed'
+            proc_result['result'] = repr(error)
+            raise _ProcedureFailed(proc_result) from error
+        proc_result['timestamp_stop'] = time.time()
+        proc_result.update(runm.resource_usage_delta(usage_before, runm.resource_usage()))
+        proc_result['cache_bytes_read'] = self._get_state()['cache_bytes_read']
+        proc_result['cache_bytes_written'] = self._get_state()['cache_bytes_written']
+        proc_result['result'] = str(results)
+        return proc_result
+
+    def _call_procedure(self, proc_name: str, kwargs: dict):
+        """ calls a procedure, or gets its memoized result.
+            returns the result and the status of the proc_result
+        """
+        fn = self._procedures[proc_name]
+        key = runm.memo_key(proc_name, fn, kwargs) if proc_name in self._memoized else None
+        if key is not None:
+            hit, results = runm.read_memo(self._run_env, key)
+            if hit:
+                self._logger.info(
+                    "[simpyl logged] Procedure {} result loaded from memo {}".format(proc_name, key)
+                )
+                return results, 'cached'
 
-            proc_result['id'] = runm.register_proc_result(self._current_env, proc_result)
-            run_result['proc_results'] += [proc_result]
+        results = fn(**kwargs)
+        if key is not None:
+            runm.write_memo(self._run_env, key, results)
+        return results, 'complete'
 
-        # register the run result
+    def _record_failure(self, run_result: dict, traceback_str: str):
+        self._logger.error("[simpyl logged] run #{} failed:\n{}".format(run_result['id'], traceback_str))
         run_result['timestamp_stop'] = time.time()
-        run_result['status'] = 'complete'
-        runm.update_run_result(self._current_env, run_result)
+        run_result['status'] = 'failed'
+        run_result['traceback'] = traceback_str
+        self._update_run_result(run_result)
 
-        self.reset_state()
-        return run_result
+    def _register_run_init(self, run_result: dict, run_init: dict, convert_args_to_numbers: bool):
+        """ stores the run_init with the run, so the run can be resumed if it fails.
+            The arguments are stored as given, so whether to convert them is stored with them
+        """
+        data = runm.dump_run_init(dict(run_init, convert_args_to_numbers=convert_args_to_numbers))
+        write_session = self._get_state()['write_session']
+        if data is None:
+            return
+        elif self._send_event is not None:
+            self._send_event(('register_run_init', run_result['id'], data))
+        elif write_session is None:
+            runm.register_run_init(self._run_env, run_result['id'], data)
+        else:
+            write_session.add(runm.register_run_init, run_result['id'], data)
+
+    def _update_run_result(self, run_result: dict):
+        """ status changes are committed straight away, with any results buffered before them.
+            The log is written out before a run's final status, so it's complete once the run is seen to finish
+        """
+        if run_result['status'] not in s.UNFINISHED_STATUSES:
+            runm.flush_logger(self._logger)
+        write_session = self._get_state()['write_session']
+        if self._send_event is not None:
+            self._send_event(('update_run_result', run_result))
+        elif write_session is None:
+            runm.update_run_result(self._run_env, run_result)
+        else:
+            write_session.add(runm.update_run_result, dict(run_result))
+            write_session.flush()
+
+    def _register_proc_result(self, proc_result: dict):
+        """ sets the proc_result's ID once it's written, which is only known here when
+            running in the process that owns the database. With a write session that's
+            when the session is flushed, which it is by the end of the run
+        """
+        def set_id(proc_result_id):
+            proc_result['id'] = proc_result_id
+
+        write_session = self._get_state()['write_session']
+        if self._send_event is not None:
+            self._send_event(('register_proc_result', proc_result))
+        elif write_session is None:
+            set_id(runm.register_proc_result(self._run_env, proc_result))
+        else:
+            write_session.add(runm.register_proc_result, proc_result, on_result=set_id)
+
+    def _process_worker_main(self, conn, preload: Sequence[str]):
+        """ entry point of a forked process worker. Runs are received from the parent
+            and all results and log records are sent back through conn
+        """
+        for module_name in preload:
+            try:
+                importlib.import_module(module_name)
+            except ImportError:
+                pass
 
-    def _queue_worker(self):
+        send_lock = threading.Lock()
+
+        def send_event(event):
+            with send_lock:
+                conn.send(event)
+
+        self._send_event = send_event
+        while True:
+            task = conn.recv()
+            if task is None:
+                break
+            run_result = task[1]
+            try:
+                run_result = self._perform_run(*task)
+            except Exception:
+                if run_result['status'] != 'failed':
+                    self._record_failure(run_result, traceback.format_exc())
+            send_event(('done', run_result))
+        conn.close()
+
+    def _start_process(self, worker: dict, preload: Sequence[str]):
+        """ forks a process worker and returns the parent's end of its connection.
+            The child only has the forking thread, so a lock another thread held at the time,
+            such as in a module that doesn't reset its locks after a fork, stays held in the child
+        """
+        ctx = multiprocessing.get_context('fork')
+        parent_conn, child_conn = ctx.Pipe()
+        process = ctx.Process(
+            target=self._process_worker_main, args=(child_conn, preload),
+            name=worker['name'], daemon=True
+        )
+        process.start()
+        # close the child's end here so a crashed worker shows up as EOF
+        child_conn.close()
+        worker['pid'] = process.pid
+        return process, parent_conn
+
+    def _handle_process_run(self, conn, run_task) -> bool:
+        """ sends a run to a process worker and writes its results to the database
+            returns False if the worker died before finishing the run
+        """
+        run_loggers = {}
+        write_session = runm.WriteSession(self._current_env)
+        try:
+            conn.send(run_task)
+            while True:
+                event = conn.recv()
+                if event[0] == 'done':
+                    return True
+                elif event[0] == 'log':
+                    _, run_result_id, record = event
+                    if run_result_id not in run_loggers:
+                        run_loggers[run_result_id] = runm.run_logger(self._current_env, run_result_id)
+                    run_loggers[run_result_id].handle(record)
+                elif event[0] == 'update_run_result':
+                    # the run's log records were sent before its final status, so they're written out first
+                    if event[1]['status'] not in s.UNFINISHED_STATUSES and event[1]['id'] in run_loggers:
+                        runm.flush_logger(run_loggers[event[1]['id']])
+                    write_session.add(runm.update_run_result, event[1])
+                    write_session.flush()
+                elif event[0] == 'register_proc_result':
+                    write_session.add(runm.register_proc_result, event[1])
+                    write_session.flush_if_due()
+                elif event[0] == 'register_run_init':
+                    write_session.add(runm.register_run_init, event[1], event[2])
+                elif event[0] == 'register_figure':
+                    runm.register_figure(self._current_env, event[1])
+        except (EOFError, BrokenPipeError, ConnectionResetError):
+            return False
+        finally:
+            try:
+                write_session.close()
+            finally:
+                for logger in run_loggers.values():
+                    runm.close_logger(logger)
+
+    def _process_queue_worker(self, worker: dict, process, conn, preload: Sequence[str]):
+        while True:
+            run_init, run_result, convert_args_to_numbers = self._queue.get()
+            worker['status'] = 'running'
+            worker['run_result_id'] = run_result['id']
+            try:
+                if not self._handle_process_run(conn, (run_init, run_result, convert_args_to_numbers)):
+                    # the worker crashed, so record the run as failed and fork a new worker.
+                    # this forks while the other queue workers' threads are running, see _start_process
+                    process.join()
+                    self._fail_run(
+                        run_result['id'],
+                        "worker process exited with code {}".format(process.exitcode)
+                    )
+                    conn.close()
+                    process, conn = self._start_process(worker, preload)
+            except Exception:
+                self._fail_run(run_result['id'], traceback.format_exc())
+            finally:
+                worker['status'] = 'idle'
+                worker['run_result_id'] = None
+                worker['runs_completed'] += 1
+                self._queue.task_done()
+
+    def _fail_run(self, run_result_id: int, reason: str):
+        """ marks a run as failed after it was lost by its worker
+        """
+        # logged before the status is updated, so the log is complete once the run is seen to fail
+        runm.create_dir_if_needed(runm.run_path(self._current_env, run_result_id))
+        logger = runm.run_logger(self._current_env, run_result_id, mode='a')
+        logger.error("[simpyl logged] run #{} failed: {}".format(run_result_id, reason))
+        runm.close_logger(logger)
+        run_result = runm.get_single_run_result(self._current_env, run_result_id)
+        run_result['timestamp_stop'] = time.time()
+        run_result['status'] = 'failed'
+        run_result['traceback'] = reason
+        runm.update_run_result(self._current_env, run_result)
+
+    def _queue_worker(self, worker: dict):
         while True:
             run_init, run_result, convert_args_to_numbers = self._queue.get()
-            self._perform_run(run_init, run_result, convert_args_to_numbers)
-            self._queue.task_done()
+            worker['status'] = 'running'
+            worker['run_result_id'] = run_result['id']
+            try:
+                self._perform_run(run_init, run_result, convert_args_to_numbers)
+            except Exception:
+                # failures in procedures are recorded by the run, but the worker carries on either way
+                if run_result['status'] != 'failed':
+                    self._fail_run(run_result['id'], traceback.format_exc())
+            finally:
+                worker['status'] = 'idle'
+                worker['run_result_id'] = None
+                worker['runs_completed'] += 1
+                self._queue.task_done()
 
     def queue_run_init(self, run_init, convert_args_to_numbers):
         """ Sets up a run and adds it to the queue
@@ -190,14 +726,143 @@ class Simpyl(object):
         run_result = runm.to_run_result(run_init)
         run_result['id'] = runm.register_run_result(self._current_env, run_result)
         self._queue.put((run_init, run_result, convert_args_to_numbers))
+        return run_result
 
-    def start_queue(self):
-        threading.Thread(target=self._queue_worker, daemon=True).start()
+    def start_queue(self,
+                    max_workers: int = s.DEFAULT_MAX_WORKERS,
+                    worker_type: str = s.DEFAULT_WORKER_TYPE,
+                    preload: Sequence[str] = s.PRELOAD_MODULES):
+        """ starts max_workers workers which take runs off the queue concurrently.
+            Calling this again adds more workers to the pool
+
+            worker_type 'thread' runs procedures in this process. worker_type 'process' forks
+            a process per worker, which imports the preload modules once on start up and runs
+            the procedures, sending the results back to this process to be written.
+            The processes are all forked by the calling thread before their queue workers' threads start,
+            so call this before starting any other threads. Workers forked to replace crashed ones are
+            forked by their queue worker's thread, while the other threads are running
+        """
+        if worker_type not in s.WORKER_TYPES:
+            raise ValueError("worker_type must be one of {}".format(s.WORKER_TYPES))
+        if self._worker_type is None:
+            self._worker_type = worker_type
+        workers = [runm.to_worker_status(len(self._workers) + i, worker_type) for i in range(max_workers)]
+        self._workers += workers
+        if worker_type == 'process':
+            processes = [self._start_process(worker, preload) for worker in workers]
+            targets = [(self._process_queue_worker, (worker, process, conn, preload))
+                       for worker, (process, conn) in zip(workers, processes)]
+        else:
+            targets = [(self._queue_worker, (worker,)) for worker in workers]
+        for worker, (target, args) in zip(workers, targets):
+            threading.Thread(target=target, args=args, name=worker['name'], daemon=True).start()
+
+    def get_workers(self) -> List[dict]:
+        """ returns a snapshot of the status of each queue worker
+        """
+        return [dict(worker) for worker in self._workers]
 
-    def run(self, procs, description):
+    def get_queue_size(self) -> int:
+        """ returns the number of runs waiting for a free worker
+        """
+        return self._queue.qsize()
+
+    def wait(self):
+        """ waits until every queued run, including the runs of sweeps, has finished.
+            Queue workers are daemon threads, so a script which queues runs should wait for them before it exits
+            raises RuntimeError if runs are queued but no queue workers have been started
+        """
+        if not self._workers and self._queue.unfinished_tasks:
+            raise RuntimeError("runs are queued but no queue workers are running, see start_queue")
+        self._queue.join()
+
+    def sweep(self,
+              procs,
+              grid: dict,
+              description: str,
+              n_samples: Optional[int] = None,
+              seed: Optional[int] = None,
+              max_workers: Optional[int] = s.DEFAULT_SWEEP_WORKERS) -> dict:
+        """ queues a run for each combination of the procedure arguments in grid, replacing the
+            arguments given in procs. See run_manager.expand_sweep for the grid and random search options
+
+            The runs are registered together under a new sweep and queued. If fewer than max_workers
+            queue workers are running, more thread workers are started so the runs are performed concurrently.
+            A queue of process workers isn't added to, as they are only forked by start_queue before other
+            threads start, so the runs wait for its workers. Use wait to wait for the runs to finish
+            returns the sweep, with the run_result of each run
+        """
+        if n_samples is not None and seed is None:
+            # the seed is recorded so a random search can be repeated
+            seed = random.randrange(2 ** 32)
+        sweep_runs = runm.expand_sweep(procs, grid, n_samples, seed)
+        sweep = runm.to_sweep(self._current_env, description, {
+            'procs': procs, 'grid': grid, 'n_samples': n_samples, 'seed': seed
+        })
+
+        run_inits, run_results = [], []
+        for params, sweep_procs in sweep_runs:
+            run_init = runm.to_run_init(
+                self._current_env, sweep_procs,
+                "{} ({})".format(description, ", ".join("{}={}".format(k, v) for k, v in params.items()))
+            )
+            run_result = runm.to_run_result(run_init)
+            run_result['sweep_params'] = params
+            run_inits.append(run_init)
+            run_results.append(run_result)
+        sweep['id'] = runm.register_sweep(self._current_env, sweep, run_results)
+
+        if max_workers is not None and self._worker_type != 'process' and len(self._workers) < max_workers:
+            self.start_queue(max_workers - len(self._workers), 'thread')
+        for run_init, run_result in zip(run_inits, run_results):
+            self._queue.put((run_init, run_result, False))
+        sweep['run_results'] = run_results
+        return sweep
+
+    def resume_run_init(self, run_result_id: int) -> dict:
+        """ creates the run_init for a new run which resumes a failed run. Procedures that completed
+            in the failed run aren't called again: their recorded results are reused, and the cache
+            files they wrote are read from the environment as before. The others are called as before,
+            with the run_init's convert_args_to_numbers saying whether the failed run converted their arguments
+            raises ValueError if the run doesn't exist, hasn't failed or its arguments couldn't be stored
+        """
+        run_result = self.get_single_run_result(run_result_id)
+        if run_result is None:
+            raise ValueError("run #{} doesn't exist".format(run_result_id))
+        if run_result['status'] != 'failed':
+            raise ValueError("run #{} is {}, only failed runs can be resumed".format(
+                run_result_id, run_result['status']))
+        data = runm.get_run_init(self._current_env, run_result_id)
+        if data is None:
+            raise ValueError("run #{} can't be resumed as its arguments weren't stored".format(run_result_id))
+        run_init = pickle.loads(data)
+        run_init['environment'] = self._current_env
+        return runm.to_resumed_run_init(run_init, run_result)
+
+    def resume(self, run_result_id: int) -> dict:
+        """ resumes a failed run in a new run, from the procedures that didn't complete.
+            See resume_run_init
+        """
+        run_init = self.resume_run_init(run_result_id)
+        run_result = runm.to_run_result(run_init)
+        run_result['id'] = runm.register_run_result(self._current_env, run_result)
+        return self._perform_run(run_init, run_result, run_init.get('convert_args_to_numbers', False))
+
+    def run(self,
+            procs,
+            description,
+            profile: bool = False,
+            trace_memory: bool = False,
+            max_parallel: int = s.DEFAULT_PROC_WORKERS):
         """ starts a run with the listed procedures
+
+            If profile is True, each procedure call is profiled with cProfile. If trace_memory
+            is True, the memory each procedure allocates is traced with tracemalloc.
+            The reports are saved in the run folder, and summarised in the proc_results
+
+            Up to max_parallel procedures which declared their dependencies are run at once
         """
-        run_init = runm.to_run_init(self._current_env, procs, description)
+        run_init = runm.to_run_init(self._current_env, procs, description, profile, trace_memory, max_parallel)
         run_result = runm.to_run_result(run_init)
         run_result['id'] = runm.register_run_result(self._current_env, run_result)
         return self._perform_run(run_init, run_result, False)
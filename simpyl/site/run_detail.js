@@ -45,7 +45,8 @@ createApp({
     return {
       run_result: {},
       log: "",
-      figures: []
+      figures: [],
+      thumbnails: []
     }
   },
 
@@ -65,9 +66,17 @@ createApp({
       if (!runid) {
         return;
       }
-      fetch('api/log/' + runid)
+      // new lines are streamed as they are written, until the run finishes
+      const source = new EventSource('api/log/' + runid + '/stream');
+      source.onmessage = (event) => this.log += event.data + "\n";
+      source.addEventListener('end', () => source.close());
+    },
+
+    resumeRun: function () {
+      // the completed procedures are reused, and the new run's page is opened
+      fetch('api/run/' + this.run_result.id + '/resume', { method: 'POST' })
         .then(response => response.json())
-        .then(jsonData => this.log = jsonData.log)
+        .then(jsonData => window.location.search = '?runid=' + jsonData.run_result.id)
     },
 
     getFigures: function () {
@@ -77,7 +86,10 @@ createApp({
       }
       fetch('api/figures/' + runid)
         .then(response => response.json())
-        .then(jsonData => this.figures = jsonData.figures)
+        .then(jsonData => {
+          this.figures = jsonData.figures;
+          this.thumbnails = jsonData.thumbnails;
+        })
     }
   }
 }).mount('#vue_run')
\ No newline at end of file
@@ -24,15 +24,23 @@ createApp({
 
   data() {
     return {
-      run_results: []
+      run_results: [],
+      next_after_id: null
     }
   },
 
   methods: {
     getRuns: function() {
-      fetch('api/runs/')
+      let url = 'api/runs/';
+      if (this.next_after_id !== null) {
+        url += '?after_id=' + this.next_after_id;
+      }
+      fetch(url)
         .then(response => response.json())
-        .then(jsonData => this.run_results = jsonData.run_results.map(formatRun))
+        .then(jsonData => {
+          this.run_results = [...this.run_results, ...jsonData.run_results.map(formatRun)];
+          this.next_after_id = jsonData.next_after_id;
+        })
     }
   },
 }).mount('#vue_runs')
\ No newline at end of file
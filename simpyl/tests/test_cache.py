@@ -0,0 +1,42 @@
+import unittest
+
+from simpyl.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = LRUCache(max_bytes=10)
+
+    def test_hit_and_version(self):
+        self.cache.put('a', 1, 'obj a', 4)
+        self.assertEqual(self.cache.get('a', 1), (True, 'obj a'))
+        # a changed file is a miss
+        self.assertEqual(self.cache.get('a', 2), (False, None))
+        self.assertEqual(self.cache.get('b', 1), (False, None))
+        stats = self.cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put('a', 1, 'obj a', 4)
+        self.cache.put('b', 1, 'obj b', 4)
+        self.cache.get('a', 1)
+        self.cache.put('c', 1, 'obj c', 4)
+
+        self.assertTrue(self.cache.get('a', 1)[0])
+        self.assertFalse(self.cache.get('b', 1)[0])
+        self.assertTrue(self.cache.get('c', 1)[0])
+        stats = self.cache.get_stats()
+        self.assertEqual((stats['evictions'], stats['n_bytes']), (1, 8))
+
+    def test_too_large_and_invalidate(self):
+        self.cache.put('big', 1, 'obj', 11)
+        self.assertFalse(self.cache.get('big', 1)[0])
+
+        self.cache.put('a', 1, 'obj a', 4)
+        self.cache.invalidate('a')
+        self.assertFalse(self.cache.get('a', 1)[0])
+        self.assertEqual(self.cache.get_stats()['n_bytes'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,236 @@
+import gc
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+import simpyl.database as db
+
+
+class TestDatabaseBaseSetup(unittest.TestCase):
+    """ creates a fresh database in a temporary directory before each test
+    """
+
+    def setUp(self):
+        self.environment = tempfile.mkdtemp()
+        db.reset_database(self.environment)
+
+    def tearDown(self):
+        db.close_connections(self.environment)
+        shutil.rmtree(self.environment, ignore_errors=True)
+
+    def register_run(self, description: str = 'test_run') -> int:
+        return db.register_run_result(self.environment, {
+            'id': None, 'timestamp_start': 12345.0, 'timestamp_stop': None,
+            'status': 'pending', 'description': description,
+            'environment': self.environment
+        })
+
+
+class TestConnectionPool(TestDatabaseBaseSetup):
+    def test_connection_reused_per_thread(self):
+        db_con = db.get_connection(self.environment)
+        self.assertIs(db.get_connection(self.environment), db_con)
+        self.assertEqual(db_con.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(db.get_connection(self.environment)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], db_con)
+
+    def test_reset_replaces_connections(self):
+        """ a reset closes the pooled connections and the data is gone afterwards
+        """
+        self.register_run()
+        db_con = db.get_connection(self.environment)
+        db.reset_database(self.environment)
+
+        self.assertIsNot(db.get_connection(self.environment), db_con)
+        self.assertEqual(db.get_run_results(self.environment), [])
+
+    def test_read_while_writing(self):
+        """ readers see the last committed data while another connection holds a write transaction
+        """
+        self.register_run()
+        writer = db.get_connection(self.environment)
+        writer.execute("BEGIN IMMEDIATE")
+        writer.execute("UPDATE run_result SET status = 'running'")
+
+        statuses = []
+        thread = threading.Thread(
+            target=lambda: statuses.extend(r['status'] for r in db.get_run_results(self.environment))
+        )
+        thread.start()
+        thread.join()
+        writer.rollback()
+        self.assertEqual(statuses, ['pending'])
+
+    def test_connections_closed_when_threads_exit(self):
+        """ short-lived threads, like those of the webserver's requests, don't leave connections open
+        """
+        self.register_run()
+        for _ in range(200):
+            thread = threading.Thread(target=db.get_run_results, args=(self.environment,))
+            thread.start()
+            thread.join()
+        gc.collect()
+        self.assertLessEqual(len(db._pool[db.db_path(self.environment)]), 2)
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        self.environment = tempfile.mkdtemp()
+
+    def tearDown(self):
+        db.close_connections(self.environment)
+        shutil.rmtree(self.environment, ignore_errors=True)
+
+    def test_upgrade_unversioned_database(self):
+        """ a database made before schema versioning is upgraded without losing data
+        """
+        db_con = sqlite3.connect(os.path.join(self.environment, 'simpyl.db'))
+        db_con.execute("""
+            CREATE TABLE run_result (id INTEGER PRIMARY KEY, timestamp_start REAL, timestamp_stop REAL,
+                                     description TEXT, status TEXT, environment TEXT);""")
+        db_con.execute("""
+            CREATE TABLE proc_result (id INTEGER PRIMARY KEY, proc_name TEXT, run_order INTEGER,
+                                      timestamp_start REAL, timestamp_stop REAL, result TEXT,
+                                      arguments_str TEXT, run_result_id INTEGER);""")
+        db_con.execute("INSERT INTO run_result VALUES (NULL, 1.0, 2.0, 'old run', 'complete', 'env');")
+        db_con.commit()
+        db_con.close()
+
+        self.assertEqual(db.migrate_database(self.environment), db.SCHEMA_VERSION)
+        self.assertEqual(db.get_schema_version(self.environment), db.SCHEMA_VERSION)
+        runs = db.get_run_results(self.environment)
+        self.assertEqual([r['description'] for r in runs], ['old run'])
+
+        # migrating again does nothing
+        self.assertEqual(db.migrate_database(self.environment), db.SCHEMA_VERSION)
+
+    def test_backfill_figures(self):
+        """ figures saved before the figure table existed are indexed by the migration
+        """
+        db.close_connections(self.environment)
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(db.db_path(self.environment) + suffix):
+                os.remove(db.db_path(self.environment) + suffix)
+        db_con = db.get_connection(self.environment)
+        for steps in db._MIGRATIONS[:3]:
+            for step in steps:
+                db_con.execute(step)
+        db_con.execute("PRAGMA user_version = 3;")
+        db_con.commit()
+        run_folder = os.path.join(self.environment, 'runs', '7')
+        os.makedirs(run_folder)
+        with open(os.path.join(run_folder, 'plots_Feature Importances_abc.png'), 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n' + b'\0\0\0\rIHDR' + (640).to_bytes(4, 'big') + (480).to_bytes(4, 'big'))
+
+        db.migrate_database(self.environment)
+        figures = db.get_figures(self.environment, 7)
+        self.assertEqual(len(figures), 1)
+        self.assertEqual(
+            (figures[0]['proc_name'], figures[0]['title'], figures[0]['width'], figures[0]['height']),
+            ('plots', 'Feature Importances', 640, 480)
+        )
+
+    def test_indexes_used(self):
+        db.reset_database(self.environment)
+        plan = db.get_connection(self.environment).execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM proc_result WHERE run_result_id = ? ORDER BY run_order", [1]
+        ).fetchall()
+        self.assertIn('proc_result_run_order', str(plan))
+
+
+class TestRunResults(TestDatabaseBaseSetup):
+    def setUp(self):
+        super(TestRunResults, self).setUp()
+        self.run_ids = [self.register_run('run {}'.format(i)) for i in range(5)]
+        for run_id in self.run_ids:
+            for run_order in [1, 0]:
+                db.register_proc_result(self.environment, {
+                    'id': None, 'proc_name': 'proc {}'.format(run_order), 'run_order': run_order,
+                    'timestamp_start': 1.0, 'timestamp_stop': 2.0, 'result': str(run_id),
+                    'arguments_str': '', 'run_result_id': run_id
+                })
+
+    def test_proc_results_attached(self):
+        for run in db.get_run_results(self.environment):
+            self.assertEqual([p['run_order'] for p in run['proc_results']], [0, 1])
+            self.assertEqual({p['result'] for p in run['proc_results']}, {str(run['id'])})
+
+    def test_pages(self):
+        """ paging through the runs in either order returns each run once
+        """
+        for order, expected in [('asc', self.run_ids), ('desc', self.run_ids[::-1])]:
+            ids = []
+            after_id = None
+            while True:
+                page = db.get_run_results(self.environment, after_id=after_id, limit=2, order=order)
+                if not page:
+                    break
+                ids += [run['id'] for run in page]
+                after_id = page[-1]['id']
+            self.assertEqual(ids, expected)
+
+    def test_single_run_result(self):
+        run = db.get_single_run_result(self.environment, self.run_ids[2])
+        self.assertEqual(run['description'], 'run 2')
+        self.assertEqual(len(run['proc_results']), 2)
+        self.assertIsNone(db.get_single_run_result(self.environment, 1000))
+
+
+class TestWriteSession(TestDatabaseBaseSetup):
+    def setUp(self):
+        super(TestWriteSession, self).setUp()
+        self.run_id = self.register_run()
+
+    def proc_result(self, run_order: int) -> dict:
+        return {'id': None, 'proc_name': 'proc', 'run_order': run_order,
+                'timestamp_start': 1.0, 'timestamp_stop': 2.0, 'result': '',
+                'arguments_str': '', 'run_result_id': self.run_id}
+
+    def n_proc_results(self) -> int:
+        return len(db.get_single_run_result(self.environment, self.run_id)['proc_results'])
+
+    def test_writes_committed_on_flush(self):
+        session = db.WriteSession(self.environment, flush_interval=60)
+        for run_order in range(3):
+            session.add(db.register_proc_result, self.proc_result(run_order))
+        session.flush_if_due()
+        self.assertEqual(self.n_proc_results(), 0)
+        session.flush()
+        self.assertEqual(self.n_proc_results(), 3)
+
+    def test_on_result_called_after_commit(self):
+        session = db.WriteSession(self.environment, flush_interval=60)
+        ids = []
+        for run_order in range(3):
+            session.add(db.register_proc_result, self.proc_result(run_order), on_result=ids.append)
+        self.assertEqual(ids, [])
+        session.flush()
+        proc_results = db.get_single_run_result(self.environment, self.run_id)['proc_results']
+        self.assertEqual(ids, [proc_result['id'] for proc_result in proc_results])
+
+    def test_writes_committed_after_interval(self):
+        session = db.WriteSession(self.environment, flush_interval=0.05)
+        session.add(db.register_proc_result, self.proc_result(0))
+        deadline = time.monotonic() + 10
+        while self.n_proc_results() == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.n_proc_results(), 1)
+
+    def test_failed_write_raised_on_flush(self):
+        session = db.WriteSession(self.environment, flush_interval=0.01)
+        session.add(db.register_proc_result, {'id': None})
+        time.sleep(0.1)
+        with self.assertRaises(KeyError):
+            session.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
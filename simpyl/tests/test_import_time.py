@@ -0,0 +1,35 @@
+import json
+import subprocess
+import sys
+import unittest
+
+# seconds `import simpyl` may take in a fresh interpreter
+IMPORT_TIME_BUDGET = 0.25
+HEAVY_MODULES = ['numpy', 'matplotlib.pyplot', 'flask']
+
+_IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import simpyl
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed, 'modules': [m for m in %r if m in sys.modules]}))
+""" % HEAVY_MODULES
+
+
+def time_import() -> dict:
+    output = subprocess.run(
+        [sys.executable, '-c', _IMPORT_SCRIPT], check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output)
+
+
+class TestImportTime(unittest.TestCase):
+    def test_import_is_fast(self):
+        # the best of a few runs, to ignore a slow first run while files are compiled and cached
+        results = [time_import() for _ in range(3)]
+        self.assertEqual(results[-1]['modules'], [])
+        self.assertLess(min(r['elapsed'] for r in results), IMPORT_TIME_BUDGET)
+
+
+if __name__ == '__main__':
+    unittest.main()
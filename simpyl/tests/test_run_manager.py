@@ -0,0 +1,315 @@
+import contextlib
+import io
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+
+import simpyl.run_manager as runm
+
+
+def nested_procedure(n):
+    """ a procedure whose code holds nested code objects and a set constant
+    """
+    def square(x):
+        return x * x
+
+    values = [square(i) for i in range(n) if i not in {'a', 'b', 'c'}]
+    return sorted(values, key=lambda v: -v)
+
+
+class TestCacheBaseSetup(unittest.TestCase):
+    """ creates an empty environment directory before each test
+    """
+
+    def setUp(self):
+        self.environment = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.environment, ignore_errors=True)
+
+
+class TestCacheFormats(TestCacheBaseSetup):
+    def test_round_trip(self):
+        array = np.arange(12, dtype=np.float32).reshape(3, 4)
+        for filename in ['a.csv', 'a.npy', 'a.pkl']:
+            runm.write_cache(self.environment, filename, array)
+            np.testing.assert_array_equal(runm.read_cache(self.environment, filename), array)
+
+        # the binary format keeps the dtype
+        self.assertEqual(runm.read_cache(self.environment, 'a.npy').dtype, np.float32)
+
+    def test_npz(self):
+        arrays = {'X': np.ones((2, 3)), 'y': np.arange(2)}
+        runm.write_cache(self.environment, 'data.npz', arrays)
+        loaded = runm.read_cache(self.environment, 'data.npz')
+        self.assertEqual(sorted(loaded), ['X', 'y'])
+        np.testing.assert_array_equal(loaded['y'], arrays['y'])
+
+    def test_mmap(self):
+        array = np.arange(1000, dtype=np.int64)
+        runm.write_cache(self.environment, 'big.npy', array)
+        mapped = runm.read_cache(self.environment, 'big.npy', mmap=True)
+        self.assertIsInstance(mapped, np.memmap)
+        self.assertFalse(mapped.flags.writeable)
+        np.testing.assert_array_equal(mapped, array)
+
+        runm.write_cache(self.environment, 'small.pkl', array)
+        with self.assertRaises(ValueError):
+            runm.read_cache(self.environment, 'small.pkl', mmap=True)
+
+    def test_rewrite_while_mapped(self):
+        runm.write_cache(self.environment, 'big.npy', np.arange(1e6))
+        mapped = runm.read_cache(self.environment, 'big.npy', mmap=True)
+        # the file is replaced rather than truncated, so the old mapping stays readable
+        runm.write_cache(self.environment, 'big.npy', np.arange(10.))
+        self.assertEqual(mapped.sum(), np.arange(1e6).sum())
+        np.testing.assert_array_equal(runm.read_cache(self.environment, 'big.npy'), np.arange(10.))
+        self.assertEqual(os.listdir(self.environment), ['big.npy'])
+
+
+class TestPickle5(TestCacheBaseSetup):
+    def test_round_trip(self):
+        obj = {'X': np.arange(100, dtype=np.float64).reshape(10, 10),
+               'y': np.arange(7, dtype=np.int8),
+               'name': 'model',
+               'columns': np.arange(20)[::2]}
+        runm.write_cache(self.environment, 'model.pkl5', obj)
+        loaded = runm.read_cache(self.environment, 'model.pkl5')
+
+        self.assertEqual(loaded['name'], 'model')
+        for key in ['X', 'y', 'columns']:
+            np.testing.assert_array_equal(loaded[key], obj[key])
+            self.assertEqual(loaded[key].dtype, obj[key].dtype)
+        # the contiguous arrays are views of the mapped file, aligned for their dtype
+        self.assertFalse(loaded['X'].flags.writeable)
+        self.assertTrue(loaded['X'].flags.aligned)
+
+    def test_rewrite_while_mapped(self):
+        runm.write_cache(self.environment, 'model.pkl5', {'w': np.arange(1e6)})
+        old = runm.read_cache(self.environment, 'model.pkl5')
+        # the file is replaced rather than truncated, so the old arrays stay readable
+        runm.write_cache(self.environment, 'model.pkl5', {'w': np.arange(10.)})
+        self.assertEqual(old['w'].sum(), np.arange(1e6).sum())
+        np.testing.assert_array_equal(runm.read_cache(self.environment, 'model.pkl5')['w'], np.arange(10.))
+        self.assertEqual(os.listdir(self.environment), ['model.pkl5'])
+
+    def test_not_pickle5(self):
+        runm.write_cache(self.environment, 'plain.pkl', [1, 2])
+        os.rename(os.path.join(self.environment, 'plain.pkl'),
+                  os.path.join(self.environment, 'plain.pkl5'))
+        with self.assertRaises(ValueError):
+            runm.read_cache(self.environment, 'plain.pkl5')
+
+
+class TestCompressedCache(TestCacheBaseSetup):
+    def test_round_trip(self):
+        obj = {'X': np.zeros((100, 100)), 'name': 'zeros'}
+        for filename in ['obj.pkl.gz', 'obj.pkl.xz']:
+            runm.write_cache(self.environment, filename, obj, compression_level=1)
+            loaded = runm.read_cache(self.environment, filename)
+            np.testing.assert_array_equal(loaded['X'], obj['X'])
+            # the zeros compress to a fraction of their 80kB
+            self.assertLess(os.path.getsize(os.path.join(self.environment, filename)), 10000)
+
+    def test_stream(self):
+        for filename in ['rows.gz', 'rows.xz', 'rows.pkl']:
+            n_items = runm.write_cache_iter(
+                self.environment, filename, (np.full(10, i) for i in range(50))
+            )
+            self.assertEqual(n_items, 50)
+            rows = list(runm.read_cache_iter(self.environment, filename))
+            self.assertEqual(len(rows), 50)
+            np.testing.assert_array_equal(rows[-1], np.full(10, 49))
+
+    def test_truncated_stream(self):
+        runm.write_cache_iter(self.environment, 'rows.pkl', [np.arange(100)] * 3)
+        path = os.path.join(self.environment, 'rows.pkl')
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 10)
+        with self.assertRaises(Exception):
+            list(runm.read_cache_iter(self.environment, 'rows.pkl'))
+
+
+class TestBufferedFileHandler(TestCacheBaseSetup):
+    def setUp(self):
+        super(TestBufferedFileHandler, self).setUp()
+        self.path = os.path.join(self.environment, 'test.log')
+        self.logger = logging.Logger('test')
+
+    def read(self) -> str:
+        with open(self.path) as f:
+            return f.read()
+
+    def test_written_on_close(self):
+        self.logger.addHandler(runm.BufferedFileHandler(self.path, flush_interval=60))
+        for i in range(100):
+            self.logger.info("line %d", i)
+        runm.close_logger(self.logger)
+        self.assertEqual(self.read().splitlines(), ["line {}".format(i) for i in range(100)])
+
+    def test_flushed_within_interval(self):
+        self.logger.addHandler(runm.BufferedFileHandler(self.path, flush_interval=0.05))
+        self.logger.info("first")
+        deadline = time.monotonic() + 5
+        while self.read() != "first\n" and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.read(), "first\n")
+        runm.close_logger(self.logger)
+
+    def test_drop_when_full(self):
+        handler = runm.BufferedFileHandler(self.path, max_queued=1, overflow='drop')
+        self.logger.addHandler(handler)
+        # stall the writer on the first record, so the second fills the queue and the third is dropped
+        release = threading.Event()
+        write = handler._file.write
+        handler._file.write = lambda line: release.wait() and write(line)
+        self.logger.info("first")
+        while not handler._queue.empty():
+            time.sleep(0.01)
+        self.logger.info("second")
+        self.logger.info("third")
+        release.set()
+        runm.close_logger(self.logger)
+
+        self.assertEqual(handler.dropped, 1)
+        self.assertEqual(
+            self.read().splitlines(),
+            ["first", "second", "[simpyl logged] 1 log records were dropped as the log queue was full"]
+        )
+
+
+    def test_write_error_doesnt_stop_writer(self):
+        handler = runm.BufferedFileHandler(self.path, flush_interval=60)
+        self.logger.addHandler(handler)
+        self.logger.info("bad \udcff")
+        write = handler._file.write
+
+        def fail_lost(line):
+            if line.startswith("lost"):
+                raise OSError(28, "No space left on device")
+            return write(line)
+
+        handler._file.write = fail_lost
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            self.logger.info("lost")
+            self.logger.info("after")
+            runm.close_logger(self.logger)
+        self.assertEqual(self.read().splitlines(), ["bad \\udcff", "after"])
+        self.assertIn("No space left on device", stderr.getvalue())
+
+
+class TestReadLog(TestCacheBaseSetup):
+    def setUp(self):
+        super(TestReadLog, self).setUp()
+        runm.create_dir_if_needed(runm.run_path(self.environment, 1))
+        self.log_path = runm.run_path(self.environment, 1, 'run_1.log')
+
+    def write(self, text: str):
+        with open(self.log_path, 'a') as f:
+            f.write(text)
+
+    def test_offsets(self):
+        self.assertEqual(runm.read_log(self.environment, 1), ('', 0))
+        self.write("first\nsec")
+        log, offset = runm.read_log(self.environment, 1)
+        self.assertEqual((log, offset), ("first\n", 6))
+
+        # the partly written line is returned once it is finished
+        self.write("ond\nthird\n")
+        self.assertEqual(runm.read_log(self.environment, 1, offset), ("second\nthird\n", 19))
+        self.assertEqual(runm.read_log(self.environment, 1, 19), ('', 19))
+
+    def test_max_bytes(self):
+        self.write("a" * 10 + "\n" + "b" * 10 + "\n")
+        self.assertEqual(runm.read_log(self.environment, 1, 0, max_bytes=15), ("a" * 10 + "\n", 11))
+        # a line longer than max_bytes is returned in pieces
+        self.assertEqual(runm.read_log(self.environment, 1, 11, max_bytes=5), ("b" * 5, 16))
+
+
+class TestProcGraph(unittest.TestCase):
+    def graph(self, names, dependencies):
+        return runm.to_proc_graph([{'proc_name': name} for name in names], dependencies)
+
+    def test_fan_out(self):
+        """ plots which only read the model wait for the trainer but not for each other
+        """
+        dependencies = {
+            'train': runm.to_proc_dependencies(None, ['data'], ['model']),
+            'plot': runm.to_proc_dependencies(None, ['model'], None),
+            'report': runm.to_proc_dependencies(['plot'], None, None),
+        }
+        self.assertEqual(self.graph(['train', 'plot', 'plot', 'report'], dependencies),
+                         [set(), {0}, {0}, {1, 2}])
+
+    def test_write_after_read(self):
+        dependencies = {
+            'read': runm.to_proc_dependencies(None, ['model'], None),
+            'write': runm.to_proc_dependencies(None, None, ['model']),
+        }
+        self.assertEqual(self.graph(['read', 'write', 'write'], dependencies), [set(), {0}, {0, 1}])
+
+    def test_undeclared_procedures_are_barriers(self):
+        dependencies = {'a': runm.to_proc_dependencies([], None, None)}
+        self.assertEqual(self.graph(['a', 'a', 'other', 'a'], dependencies), [set(), set(), {0, 1}, {2}])
+
+
+class TestExpandSweep(unittest.TestCase):
+    procs = [('train', {'n_estimators': 10, 'depth': 3}), ('plot', {})]
+
+    def test_grid(self):
+        sweep_runs = runm.expand_sweep(self.procs, {'train': {'n_estimators': [1, 2], 'depth': [4, 5]}})
+        self.assertEqual([params for params, _ in sweep_runs], [
+            {'train.n_estimators': n, 'train.depth': d} for n in [1, 2] for d in [4, 5]
+        ])
+        self.assertEqual(sweep_runs[1][1], [('train', {'n_estimators': 1, 'depth': 5}), ('plot', {})])
+
+    def test_random_search(self):
+        grid = {'train': {'n_estimators': list(range(100)), 'depth': [1, 2]}}
+        sweep_runs = runm.expand_sweep(self.procs, grid, n_samples=50, seed=1)
+        combinations = [tuple(params.values()) for params, _ in sweep_runs]
+        self.assertEqual(len(set(combinations)), 50)
+        self.assertEqual(runm.expand_sweep(self.procs, grid, n_samples=50, seed=1), sweep_runs)
+        # a sample larger than the grid is the whole grid
+        self.assertEqual(len(runm.expand_sweep(self.procs, {'train': {'depth': [1, 2]}}, n_samples=5)), 2)
+
+    def test_distributions(self):
+        grid = {'train': {'n_estimators': {'randint': [1, 3]}, 'depth': {'loguniform': [0.01, 1]}}}
+        for params, _ in runm.expand_sweep(self.procs, grid, n_samples=20, seed=0):
+            self.assertIn(params['train.n_estimators'], [1, 2, 3])
+            self.assertTrue(0.01 <= params['train.depth'] <= 1)
+
+    def test_bad_grid(self):
+        for grid in [{'other': {'a': [1]}}, {'train': {'depth': []}}, {'train': {'depth': {'normal': [0, 1]}}}]:
+            with self.assertRaises(ValueError):
+                runm.expand_sweep(self.procs, grid, n_samples=2)
+        # distributions can only be sampled
+        with self.assertRaises(ValueError):
+            runm.expand_sweep(self.procs, {'train': {'depth': {'uniform': [0, 1]}}})
+
+
+class TestMemoKey(unittest.TestCase):
+    def test_key_stable_between_interpreters(self):
+        """ the key doesn't depend on memory addresses or the hash seed of the interpreter computing it
+        """
+        script = ("import simpyl.run_manager as runm; from simpyl.tests.test_run_manager import nested_procedure; "
+                  "print(runm.memo_key('nested', nested_procedure, {'n': 3}))")
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        keys = [
+            subprocess.run([sys.executable, '-c', script], cwd=root, check=True, capture_output=True, text=True,
+                           env=dict(os.environ, PYTHONHASHSEED=str(seed))).stdout.strip()
+            for seed in [1, 2]
+        ]
+        self.assertEqual(keys, [runm.memo_key('nested', nested_procedure, {'n': 3})] * 2)
+        self.assertNotEqual(keys[0], runm.memo_key('nested', nested_procedure, {'n': 4}))
+
+
+if __name__ == '__main__':
+    unittest.main()
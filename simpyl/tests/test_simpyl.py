@@ -0,0 +1,530 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+from unittest import mock
+
+from simpyl import Simpyl
+import simpyl.database as db
+import simpyl.run_manager as runm
+
+
+class TestSimpylBaseSetup(unittest.TestCase):
+    """ creates a fresh environment in a temporary directory before each test
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.environment = os.path.join(self.tmp_dir, 'env')
+        self.sl = Simpyl()
+        self.sl.reset_environment(self.environment)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def record_final_logs(self) -> dict:
+        """ records each run's log as it was when its final status was written to the database
+        """
+        final_logs = {}
+        update_run_result = runm.update_run_result
+
+        @db.with_db
+        def record_log(db_con, run_result):
+            if run_result['status'] not in ('pending', 'running'):
+                final_logs[run_result['id']] = self.sl.get_log(run_result['id'])
+            return update_run_result.__wrapped__(db_con, run_result)
+
+        patcher = mock.patch.object(runm, 'update_run_result', record_log)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return final_logs
+
+
+class TestQueue(TestSimpylBaseSetup):
+    def test_workers_drain_queue_concurrently(self):
+        """ two runs which wait on each other can only finish if two workers run them at once
+        """
+        barrier = threading.Barrier(2, timeout=10)
+
+        @self.sl.add_procedure('wait')
+        def wait():
+            return barrier.wait()
+
+        self.sl.start_queue(max_workers=2)
+        self.assertEqual(len(self.sl.get_workers()), 2)
+
+        for i in range(2):
+            run_init = {'description': 'run {}'.format(i),
+                        'environment': self.environment,
+                        'proc_inits': [{'proc_name': 'wait', 'run_order': 0,
+                                        'arguments': [], 'arguments_str': ''}]}
+            run_result = self.sl.queue_run_init(run_init, convert_args_to_numbers=True)
+            self.assertIsNotNone(run_result['id'])
+        self.sl.wait()
+
+        runs = self.sl.get_run_results()
+        self.assertEqual([r['status'] for r in runs], ['complete', 'complete'])
+        self.assertEqual(sum(w['runs_completed'] for w in self.sl.get_workers()), 2)
+
+    def test_wait_without_workers(self):
+        self.sl.wait()
+        run_init = runm.to_run_init(self.environment, [], 'never run')
+        self.sl.queue_run_init(run_init, convert_args_to_numbers=False)
+        with self.assertRaises(RuntimeError):
+            self.sl.wait()
+        self.assertTrue(all(w['status'] == 'idle' for w in self.sl.get_workers()))
+
+
+class TestReadCache(TestSimpylBaseSetup):
+    def test_repeated_reads_from_memory(self):
+        self.sl.write_cache({'a': 1}, 'obj.pkl')
+        first = self.sl.read_cache('obj.pkl')
+        self.assertIs(self.sl.read_cache('obj.pkl'), first)
+
+        # writing the file again replaces the object held in memory
+        self.sl.write_cache({'a': 2}, 'obj.pkl')
+        self.assertEqual(self.sl.read_cache('obj.pkl'), {'a': 2})
+
+        stats = self.sl.get_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_compressed_charged_by_object_size(self):
+        """ a compressed file much smaller than its object isn't held if the object is larger than the cache
+        """
+        sl = Simpyl(cache_max_bytes=100000)
+        sl.use_environment(self.environment)
+        sl.write_cache(bytes(1000000), 'zeros.pkl.gz')
+        self.assertLess(os.path.getsize(os.path.join(self.environment, 'zeros.pkl.gz')), 100000)
+        first = sl.read_cache('zeros.pkl.gz')
+        self.assertIsNot(sl.read_cache('zeros.pkl.gz'), first)
+        self.assertEqual(sl.get_cache_stats()['hits'], 0)
+
+
+class TestFigures(TestSimpylBaseSetup):
+    def test_savefig_records_figure(self):
+        import matplotlib.pyplot as plt
+
+        @self.sl.add_procedure('plots')
+        def plots():
+            plt.figure(figsize=(4, 3), dpi=50)
+            plt.plot([1, 2, 3])
+            self.sl.savefig('line')
+
+        run_id = self.sl.run([('plots', {})], description='plots')['id']
+        figures = self.sl.get_figures(run_id)
+        self.assertEqual(len(figures), 1)
+        self.assertTrue(figures[0].startswith('plots_line_'))
+        self.assertTrue(os.path.exists(os.path.join(self.sl.get_run_path(run_id), figures[0])))
+
+        figure = db.get_figures(self.environment, run_id)[0]
+        self.assertEqual((figure['width'], figure['height']), (200, 150))
+
+    def test_savefig_explicit_figures(self):
+        """ figures passed to savefig are all saved by the time the procedure is recorded
+        """
+        from matplotlib.figure import Figure
+
+        @self.sl.add_procedure('plots')
+        def plots(n):
+            for i in range(n):
+                fig = Figure()
+                fig.add_subplot().plot([i, i + 1])
+                self.sl.savefig('plot {}'.format(i), fig=fig)
+
+        run_id = self.sl.run([('plots', {'n': 5})], description='plots')['id']
+        figures = self.sl.get_figures(run_id)
+        self.assertEqual(len(figures), 5)
+        for filename in figures:
+            self.assertGreater(os.path.getsize(os.path.join(self.sl.get_run_path(run_id), filename)), 0)
+
+
+class TestMemoize(TestSimpylBaseSetup):
+    def test_repeated_call_uses_memo(self):
+        calls = []
+
+        @self.sl.add_procedure('square', memoize=True)
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        results = [
+            self.sl.run([('square', {'x': x})], description='square {}'.format(x))['proc_results'][0]
+            for x in [3, 3, 4]
+        ]
+        self.assertEqual(calls, [3, 4])
+        self.assertEqual([p['result'] for p in results], ['9', '9', '16'])
+        self.assertEqual([p['status'] for p in results], ['complete', 'cached', 'complete'])
+
+        stored = self.sl.get_single_run_result(2)['proc_results'][0]
+        self.assertEqual(stored['status'], 'cached')
+
+    def test_not_memoized_by_default(self):
+        calls = []
+
+        @self.sl.add_procedure('count')
+        def count():
+            calls.append(None)
+
+        for _ in range(2):
+            self.sl.run([('count', {})], description='count')
+        self.assertEqual(len(calls), 2)
+
+
+class TestRunState(TestSimpylBaseSetup):
+    def test_concurrent_runs_log_to_own_run(self):
+        """ two runs executing at the same time each log to their own file,
+            including from a thread started by the procedure
+        """
+        barrier = threading.Barrier(2, timeout=10)
+
+        @self.sl.add_procedure('logger')
+        def logger(name):
+            barrier.wait()
+            self.sl.log("in {}".format(name))
+            thread = threading.Thread(
+                target=self.sl.wrap_context(self.sl.log), args=("thread of {}".format(name),)
+            )
+            thread.start()
+            thread.join()
+            return self.sl._current_run
+
+        self.sl.start_queue(max_workers=2)
+        run_ids = {}
+        for name in ['first', 'second']:
+            run_init = {'description': name,
+                        'environment': self.environment,
+                        'proc_inits': [{'proc_name': 'logger', 'run_order': 0,
+                                        'arguments': [{'name': 'name', 'value': name}],
+                                        'arguments_str': ''}]}
+            run_ids[name] = self.sl.queue_run_init(run_init, convert_args_to_numbers=True)['id']
+        self.sl.wait()
+
+        for name, other in [('first', 'second'), ('second', 'first')]:
+            run_result = self.sl.get_single_run_result(run_ids[name])
+            self.assertEqual(run_result['proc_results'][0]['result'], str(run_ids[name]))
+            log = self.sl.get_log(run_ids[name])
+            self.assertIn("[user logged] in {}".format(name), log)
+            self.assertIn("[user logged] thread of {}".format(name), log)
+            self.assertNotIn(other, log)
+        # the run state doesn't leak out of the runs
+        self.assertEqual(self.sl._current_run, -1)
+
+    def test_run_returns_proc_result_ids(self):
+        """ the proc_results buffered by the run's write session get their ids before run returns
+        """
+        self.sl.add_procedure('noop')(lambda: None)
+        run_result = self.sl.run([('noop', {}), ('noop', {})], 'ids')
+        stored = self.sl.get_single_run_result(run_result['id'])['proc_results']
+        self.assertEqual([p['id'] for p in run_result['proc_results']], [p['id'] for p in stored])
+        self.assertTrue(all(p['id'] is not None for p in stored))
+
+
+class TestProfile(TestSimpylBaseSetup):
+    def setUp(self):
+        super().setUp()
+
+        @self.sl.add_procedure('allocate')
+        def allocate(n):
+            return len([bytes(1000) for _ in range(int(n))])
+
+    def get_proc_result(self, **kwargs):
+        self.sl.run([('allocate', {'n': 1000})], 'profiled', **kwargs)
+        run_result = self.sl.get_run_results()[-1]
+        return run_result, run_result['proc_results'][0]
+
+    def test_profile_and_trace_memory(self):
+        """ the summary is stored with the proc_result and the reports are saved in the run folder
+        """
+        run_result, proc_result = self.get_proc_result(profile=True, trace_memory=True)
+        profile = proc_result['profile']
+        self.assertEqual(proc_result['result'], '1000')
+        self.assertTrue(any('allocate' in f['function'] for f in profile['top_functions']))
+        self.assertGreater(profile['peak_memory'], 1000 * 1000)
+        self.assertTrue(profile['top_allocations'])
+        for key in ['profile_file', 'memory_file']:
+            self.assertTrue(os.path.isfile(os.path.join(self.sl.get_run_path(run_result['id']), profile[key])))
+
+    def test_overlapping_procedures_trace_memory(self):
+        """ a traced procedure finishing doesn't stop tracing for one still running
+        """
+        barrier = threading.Barrier(2, timeout=10)
+
+        @self.sl.add_procedure('short', depends_on=[])
+        def short():
+            barrier.wait()
+
+        @self.sl.add_procedure('long', depends_on=[])
+        def long():
+            barrier.wait()
+            time.sleep(0.2)
+            return len([bytes(1000) for _ in range(1000)])
+
+        self.sl.run([('short', {}), ('long', {})], 'overlapping', trace_memory=True)
+        proc_results = self.sl.get_run_results()[-1]['proc_results']
+        self.assertEqual([(p['proc_name'], p['status']) for p in proc_results],
+                         [('short', 'complete'), ('long', 'complete')])
+        self.assertGreater(proc_results[1]['profile']['peak_memory'], 1000 * 1000)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_not_profiled_by_default(self):
+        _, proc_result = self.get_proc_result()
+        self.assertIsNone(proc_result['profile'])
+
+
+class TestResourceUsage(TestSimpylBaseSetup):
+    def test_resources_recorded(self):
+        """ cpu time and cache bytes are recorded for each procedure, and cache reads
+            served from memory aren't counted
+        """
+        @self.sl.add_procedure('write')
+        def write():
+            self.sl.write_cache(list(range(10000)), 'numbers.pkl')
+            return sum(i * i for i in range(200000))
+
+        @self.sl.add_procedure('read')
+        def read():
+            self.sl.read_cache('numbers.pkl')
+            return len(self.sl.read_cache('numbers.pkl'))
+
+        self.sl.run([('write', {}), ('read', {})], 'resources')
+        write_result, read_result = self.sl.get_run_results()[-1]['proc_results']
+        size = os.path.getsize(os.path.join(self.environment, 'numbers.pkl'))
+
+        self.assertGreater(write_result['cpu_user'] + write_result['cpu_system'], 0)
+        self.assertEqual((write_result['cache_bytes_read'], write_result['cache_bytes_written']), (0, size))
+        self.assertEqual((read_result['cache_bytes_read'], read_result['cache_bytes_written']), (size, 0))
+        self.assertGreaterEqual(write_result['io_write_bytes'], size)
+        self.assertGreaterEqual(read_result['max_rss_delta'], 0)
+
+
+class TestProcedureGraph(TestSimpylBaseSetup):
+    def setUp(self):
+        super().setUp()
+        self.barrier = threading.Barrier(3, timeout=10)
+
+        @self.sl.add_procedure('train', writes=['model.pkl'])
+        def train():
+            self.sl.write_cache(2, 'model.pkl')
+
+        @self.sl.add_procedure('plot', reads=['model.pkl'])
+        def plot(i):
+            # only returns if all three plots are running at once
+            self.barrier.wait()
+            self.sl.log("plot {}".format(i))
+            return self.sl.read_cache('model.pkl') * i
+
+    def test_independent_procedures_run_in_parallel(self):
+        self.sl.run([('train', {})] + [('plot', {'i': i}) for i in range(3)], 'fan out')
+        run_result = self.sl.get_run_results()[-1]
+
+        self.assertEqual(run_result['status'], 'complete')
+        proc_results = run_result['proc_results']
+        self.assertEqual([p['run_order'] for p in proc_results], [0, 1, 2, 3])
+        self.assertEqual([p['result'] for p in proc_results[1:]], ['0', '2', '4'])
+        self.assertTrue(all(p['timestamp_start'] >= proc_results[0]['timestamp_stop'] for p in proc_results[1:]))
+        for i in range(3):
+            self.assertIn("plot {}".format(i), self.sl.get_log(run_result['id']))
+
+    def test_error_stops_run(self):
+        """ an error in one procedure is raised once the others running have finished,
+            and procedures waiting for it aren't started
+        """
+        # starts with the plots, so it always fails while they're running
+        @self.sl.add_procedure('fail', depends_on=['train'])
+        def fail():
+            self.barrier.abort()
+            raise RuntimeError("failed")
+
+        @self.sl.add_procedure('report', depends_on=['fail'])
+        def report():
+            return 'reported'
+
+        with self.assertRaises(RuntimeError):
+            self.sl.run([('train', {}), ('plot', {'i': 0}), ('fail', {}), ('report', {})], 'error')
+        run_result = self.sl.get_run_results()[-1]
+        self.assertEqual(run_result['status'], 'failed')
+        # whichever error came first is recorded
+        self.assertRegex(run_result['traceback'], "RuntimeError: failed|BrokenBarrierError")
+        self.assertEqual([(p['proc_name'], p['status']) for p in run_result['proc_results']],
+                         [('train', 'complete'), ('plot', 'failed'), ('fail', 'failed')])
+
+
+class TestFailures(TestSimpylBaseSetup):
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+        self.fail = True
+
+        @self.sl.add_procedure('prepare')
+        def prepare(n):
+            self.calls.append('prepare')
+            self.sl.write_cache(list(range(n)), 'data.pkl')
+            return n
+
+        @self.sl.add_procedure('flaky')
+        def flaky():
+            self.calls.append('flaky')
+            if self.fail:
+                raise ValueError("flaky failed")
+            return sum(self.sl.read_cache('data.pkl'))
+
+    def queue_run(self) -> int:
+        run_init = runm.to_run_init(self.environment, [('prepare', {'n': 4}), ('flaky', {})], 'flaky run')
+        return self.sl.queue_run_init(run_init, convert_args_to_numbers=False)['id']
+
+    def test_failure_recorded_and_worker_survives(self):
+        self.sl.start_queue(max_workers=1)
+        failed_id = self.queue_run()
+        self.sl.wait()
+        self.fail = False
+        complete_id = self.queue_run()
+        self.sl.wait()
+
+        failed = self.sl.get_single_run_result(failed_id)
+        self.assertEqual(failed['status'], 'failed')
+        self.assertIn("ValueError: flaky failed", failed['traceback'])
+        self.assertEqual([p['status'] for p in failed['proc_results']], ['complete', 'failed'])
+        self.assertIn("flaky failed", self.sl.get_log(failed_id))
+        self.assertEqual(self.sl.get_single_run_result(complete_id)['status'], 'complete')
+
+    def test_log_written_before_final_status(self):
+        """ the log is complete, up to the failure, once the run's status is failed
+        """
+        final_logs = self.record_final_logs()
+        with self.assertRaises(ValueError):
+            self.sl.run([('prepare', {'n': 4}), ('flaky', {})], 'flaky run')
+        run_id = self.sl.get_run_results()[-1]['id']
+        self.assertIn("ValueError: flaky failed", final_logs[run_id])
+
+    def test_resume(self):
+        """ the resumed run reuses the completed procedure and calls the failed one again
+        """
+        with self.assertRaises(ValueError):
+            self.sl.run([('prepare', {'n': 4}), ('flaky', {})], 'flaky run')
+        failed_id = self.sl.get_run_results()[-1]['id']
+        with self.assertRaises(ValueError):
+            self.sl.resume_run_init(failed_id - 1)
+
+        self.fail = False
+        self.calls = []
+        run_result = self.sl.resume(failed_id)
+
+        self.assertEqual(self.calls, ['flaky'])
+        resumed = self.sl.get_single_run_result(run_result['id'])
+        self.assertEqual((resumed['status'], resumed['resumed_from']), ('complete', failed_id))
+        self.assertEqual([(p['status'], p['result']) for p in resumed['proc_results']],
+                         [('reused', '4'), ('complete', '6')])
+        with self.assertRaises(ValueError):
+            self.sl.resume_run_init(run_result['id'])
+
+    def test_resume_converts_arguments(self):
+        """ a run queued with string arguments to convert converts them again when it's resumed
+        """
+        @self.sl.add_procedure('scale')
+        def scale(x):
+            self.calls.append(x)
+            if self.fail:
+                raise ValueError("scale failed")
+            return x * 2
+
+        self.sl.start_queue(max_workers=1)
+        run_init = {'description': 'scale', 'environment': self.environment,
+                    'proc_inits': [{'proc_name': 'scale', 'run_order': 0,
+                                    'arguments': [{'name': 'x', 'value': '5'}], 'arguments_str': 'x=5'}]}
+        failed_id = self.sl.queue_run_init(run_init, convert_args_to_numbers=True)['id']
+        self.sl.wait()
+
+        self.fail = False
+        run_result = self.sl.resume(failed_id)
+        self.assertEqual(self.calls, [5, 5])
+        self.assertEqual(self.sl.get_single_run_result(run_result['id'])['proc_results'][0]['result'], '10')
+
+
+class TestProcessQueue(TestSimpylBaseSetup):
+    def setUp(self):
+        super(TestProcessQueue, self).setUp()
+
+        @self.sl.add_procedure('pid')
+        def pid():
+            self.sl.log("logged from the worker")
+            return os.getpid()
+
+        @self.sl.add_procedure('crash')
+        def crash():
+            os._exit(1)
+
+        @self.sl.add_procedure('error')
+        def error():
+            raise KeyError("missing")
+
+        self.sl.start_queue(max_workers=1, worker_type='process', preload=())
+
+    def queue_proc(self, proc_name: str) -> dict:
+        run_init = {'description': proc_name,
+                    'environment': self.environment,
+                    'proc_inits': [{'proc_name': proc_name, 'run_order': 0,
+                                    'arguments': [], 'arguments_str': ''}]}
+        return self.sl.queue_run_init(run_init, convert_args_to_numbers=True)
+
+    def test_run_in_worker_process(self):
+        """ results and logs are written by the parent for a run in a worker process
+        """
+        run_id = self.queue_proc('pid')['id']
+        self.sl.wait()
+
+        run_result = self.sl.get_single_run_result(run_id)
+        self.assertEqual(run_result['status'], 'complete')
+        self.assertNotEqual(run_result['proc_results'][0]['result'], str(os.getpid()))
+        self.assertIn("[user logged] logged from the worker", self.sl.get_log(run_id))
+
+    def test_processes_forked_by_start_queue(self):
+        """ the processes are forked before start_queue returns, rather than by the workers' threads
+        """
+        forking_threads = []
+        start_process = self.sl._start_process
+
+        def record_thread(*args):
+            forking_threads.append(threading.current_thread())
+            return start_process(*args)
+
+        self.sl._start_process = record_thread
+        self.sl.start_queue(max_workers=2, worker_type='process', preload=())
+        self.assertEqual(forking_threads, [threading.current_thread()] * 2)
+        self.assertTrue(all(worker['pid'] for worker in self.sl.get_workers()))
+
+    def test_worker_crash(self):
+        """ a crashing worker fails its run and is replaced
+        """
+        crash_id = self.queue_proc('crash')['id']
+        pid_id = self.queue_proc('pid')['id']
+        self.sl.wait()
+
+        self.assertEqual(self.sl.get_single_run_result(crash_id)['status'], 'failed')
+        self.assertEqual(self.sl.get_single_run_result(pid_id)['status'], 'complete')
+
+    def test_log_written_before_final_status(self):
+        final_logs = self.record_final_logs()
+        run_ids = [self.queue_proc('pid')['id'], self.queue_proc('error')['id']]
+        self.sl.wait()
+        self.assertIn("[user logged] logged from the worker", final_logs[run_ids[0]])
+        self.assertIn("KeyError: 'missing'", final_logs[run_ids[1]])
+
+    def test_error_in_worker(self):
+        """ an error is recorded by the worker, which carries on with the next run
+        """
+        error_id = self.queue_proc('error')['id']
+        pid_id = self.queue_proc('pid')['id']
+        self.sl.wait()
+
+        run_result = self.sl.get_single_run_result(error_id)
+        self.assertEqual(run_result['status'], 'failed')
+        self.assertIn("KeyError: 'missing'", run_result['traceback'])
+        self.assertEqual(run_result['proc_results'][0]['status'], 'failed')
+        self.assertEqual(self.sl.get_single_run_result(pid_id)['status'], 'complete')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,316 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from simpyl import Simpyl
+import simpyl.webserver as webserver
+
+
+class TestAPIBaseSetup(unittest.TestCase):
+    """ points the webserver at a Simpyl object with a fresh environment before each test
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.environment = os.path.join(self.tmp_dir, 'env')
+        self.sl = Simpyl()
+        self.sl.reset_environment(self.environment)
+        webserver.sl = self.sl
+        self.client = webserver.app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class TestRuns(TestAPIBaseSetup):
+    def setUp(self):
+        super(TestRuns, self).setUp()
+
+        @self.sl.add_procedure('foo')
+        def foo(a):
+            return a
+
+        self.run_ids = [
+            self.sl.run([('foo', {'a': i})], description='run {}'.format(i))['id']
+            for i in range(3)
+        ]
+
+    def test_runs_paged_newest_first(self):
+        response = self.client.get('/api/runs/?limit=2')
+        self.assertEqual(response.status_code, 200)
+        page = response.get_json()
+        self.assertEqual([r['id'] for r in page['run_results']], self.run_ids[:0:-1])
+        self.assertEqual(page['run_results'][0]['proc_results'][0]['result'], '2')
+
+        page = self.client.get(
+            '/api/runs/?limit=2&after_id={}'.format(page['next_after_id'])
+        ).get_json()
+        self.assertEqual([r['id'] for r in page['run_results']], self.run_ids[:1])
+        self.assertIsNone(page['next_after_id'])
+
+    def test_runs_ascending(self):
+        page = self.client.get('/api/runs/?order=asc').get_json()
+        self.assertEqual([r['id'] for r in page['run_results']], self.run_ids)
+
+    def test_runs_bad_arguments(self):
+        self.assertEqual(self.client.get('/api/runs/?order=sideways').status_code, 400)
+        self.assertEqual(self.client.get('/api/runs/?limit=0').status_code, 400)
+
+
+class TestLog(TestAPIBaseSetup):
+    def setUp(self):
+        super(TestLog, self).setUp()
+
+        @self.sl.add_procedure('chatty')
+        def chatty(n):
+            for i in range(n):
+                self.sl.log("line {}".format(i))
+
+        self.run_id = self.sl.run([('chatty', {'n': 3})], description='chatty')['id']
+
+    def test_log_offset(self):
+        full = json.loads(self.client.get('/api/log/{}'.format(self.run_id)).data)
+        self.assertIn("[user logged] line 2", full['log'])
+
+        tail = json.loads(self.client.get('/api/log/{}?offset=0'.format(self.run_id)).data)
+        self.assertEqual(tail, full)
+        tail = json.loads(self.client.get('/api/log/{}?offset={}'.format(self.run_id, full['offset'])).data)
+        self.assertEqual(tail, {'log': '', 'offset': full['offset']})
+
+    def test_log_stream(self):
+        response = self.client.get('/api/log/{}/stream'.format(self.run_id))
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = response.get_data(as_text=True).split('\n\n')
+        self.assertIn("[user logged] line 2", events[0])
+        self.assertTrue(all(line.startswith(('data: ', 'id: ')) for line in events[0].split('\n')))
+        self.assertEqual(events[1], 'event: end\ndata: complete')
+
+        # resuming from the last event id only sends the end event
+        last_id = events[0].split('id: ')[1]
+        response = self.client.get(
+            '/api/log/{}/stream'.format(self.run_id), headers={'Last-Event-ID': last_id}
+        )
+        self.assertEqual(response.get_data(as_text=True), 'event: end\ndata: complete\n\n')
+
+
+class TestSweep(TestAPIBaseSetup):
+    def setUp(self):
+        super(TestSweep, self).setUp()
+
+        @self.sl.add_procedure('power')
+        def power(base, exponent):
+            return base ** exponent
+
+    def new_sweep(self, grid, **kwargs):
+        return self.client.post('/api/newsweep', json=dict({
+            'description': 'powers',
+            'proc_inits': [{'proc_name': 'power', 'arguments': [{'name': 'base', 'value': '2'},
+                                                               {'name': 'exponent', 'value': '1'}]}],
+            'grid': grid,
+            'max_workers': 2
+        }, **kwargs))
+
+    def test_sweep(self):
+        response = self.new_sweep({'power': {'exponent': [1, 2, 3]}})
+        self.assertEqual(response.status_code, 201)
+        sweep_id = response.get_json()['sweep']['id']
+        self.sl.wait()
+
+        sweep = self.client.get('/api/sweep/{}'.format(sweep_id)).get_json()['sweep']
+        self.assertEqual(sweep['n_runs'], 3)
+        self.assertEqual(sweep['status_counts'], {'complete': 3})
+        self.assertEqual(
+            sorted((row['params']['power.exponent'], row['results']['power']) for row in sweep['rows']),
+            [(1, '2'), (2, '4'), (3, '8')]
+        )
+        self.assertEqual(len(self.sl.get_workers()), 2)
+
+    def test_process_queue_not_added_to(self):
+        """ a sweep doesn't fork process workers from the request's thread, its runs wait for the queue's
+        """
+        self.sl.start_queue(max_workers=1, worker_type='process', preload=())
+        sweep_id = self.new_sweep({'power': {'exponent': [1, 2]}}).get_json()['sweep']['id']
+        self.sl.wait()
+
+        self.assertEqual(self.sl.get_sweep(sweep_id)['status_counts'], {'complete': 2})
+        self.assertEqual([worker['worker_type'] for worker in self.sl.get_workers()], ['process'])
+
+    def test_numpy_arguments(self):
+        """ a sweep accepts the numpy values a run does, and records them as numbers
+        """
+        import numpy as np
+
+        sweep = self.sl.sweep([('power', {'base': 2, 'exponent': 1})],
+                              {'power': {'exponent': list(np.arange(1, 3))}}, 'numpy', max_workers=1)
+        self.sl.wait()
+        rows = self.client.get('/api/sweep/{}'.format(sweep['id'])).get_json()['sweep']['rows']
+        self.assertEqual(sorted((row['params']['power.exponent'], row['results']['power']) for row in rows),
+                         [(1, '2'), (2, '4')])
+
+    def test_random_search_seed_recorded(self):
+        sweep = self.new_sweep({'power': {'exponent': {'randint': [0, 10]}}}, n_samples=4).get_json()['sweep']
+        self.assertEqual(len(sweep['run_results']), 4)
+        self.assertIsInstance(sweep['spec']['seed'], int)
+        self.sl.wait()
+
+    def test_bad_sweep(self):
+        self.assertEqual(self.new_sweep({'other': {'exponent': [1]}}).status_code, 400)
+        self.assertEqual(self.new_sweep({'power': {'exponent': [1]}}, n_samples='all').status_code, 400)
+        self.assertEqual(self.client.get('/api/sweep/99').status_code, 404)
+
+
+class TestResume(TestAPIBaseSetup):
+    def test_resume(self):
+        calls = []
+
+        @self.sl.add_procedure('first')
+        def first():
+            calls.append('first')
+
+        @self.sl.add_procedure('second')
+        def second():
+            calls.append('second')
+            if len(calls) == 2:
+                raise RuntimeError("first attempt")
+
+        with self.assertRaises(RuntimeError):
+            self.sl.run([('first', {}), ('second', {})], 'resumable')
+        failed_id = self.sl.get_run_results()[-1]['id']
+        self.sl.start_queue()
+
+        response = self.client.post('/api/run/{}/resume'.format(failed_id))
+        self.assertEqual(response.status_code, 201)
+        self.sl.wait()
+        run_result = self.client.get('/api/run/{}'.format(response.get_json()['run_result']['id'])).get_json()['run_result']
+        self.assertEqual(run_result['status'], 'complete')
+        self.assertEqual(calls, ['first', 'second', 'second'])
+
+        self.assertEqual(self.client.post('/api/run/{}/resume'.format(run_result['id'])).status_code, 400)
+        self.assertEqual(self.client.post('/api/run/99/resume').status_code, 404)
+
+    def test_resume_converts_arguments(self):
+        """ the resumed run converts the arguments from the API as the failed run did
+        """
+        attempts = []
+
+        @self.sl.add_procedure('flaky')
+        def flaky(x):
+            attempts.append(x)
+            if len(attempts) == 1:
+                raise RuntimeError("first attempt")
+            return x * 2
+
+        self.sl.start_queue()
+        self.client.post('/api/newrun', json={
+            'description': 'flaky',
+            'proc_inits': [{'proc_name': 'flaky', 'run_order': 0,
+                            'arguments': [{'name': 'x', 'value': '5'}], 'arguments_str': 'x=5'}]
+        })
+        self.sl.wait()
+        failed_id = self.sl.get_run_results()[-1]['id']
+
+        response = self.client.post('/api/run/{}/resume'.format(failed_id))
+        self.sl.wait()
+        run_result = self.sl.get_single_run_result(response.get_json()['run_result']['id'])
+        self.assertEqual(attempts, [5, 5])
+        self.assertEqual(run_result['proc_results'][0]['result'], '10')
+
+
+class TestFigure(TestAPIBaseSetup):
+    def setUp(self):
+        super(TestFigure, self).setUp()
+
+        @self.sl.add_procedure('noop')
+        def noop():
+            pass
+
+        self.run_id = self.sl.run([('noop', {})], description='figure')['id']
+        self.png = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 4
+        with open(os.path.join(self.sl.get_run_path(self.run_id), 'noop_plot_1.png'), 'wb') as f:
+            f.write(self.png)
+        self.url = '/api/figure/{}/noop_plot_1.png'.format(self.run_id)
+
+    def test_get_figure(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.png)
+        self.assertEqual(response.mimetype, 'image/png')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIsNotNone(response.last_modified)
+
+        response = self.client.get(self.url, headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_range(self):
+        response = self.client.get(self.url, headers={'Range': 'bytes=8-15'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, self.png[8:16])
+
+    def test_missing_figure(self):
+        self.assertEqual(self.client.get('/api/figure/{}/nope.png'.format(self.run_id)).status_code, 404)
+        self.assertEqual(
+            self.client.get('/api/figure/{}/..%2F..%2Fsimpyl.db'.format(self.run_id)).status_code, 404
+        )
+
+
+class TestThumbnail(TestAPIBaseSetup):
+    def test_thumbnail(self):
+        """ figures get thumbnails when saved, and figures saved without one get one when requested
+        """
+        import matplotlib.pyplot as plt
+        from PIL import Image
+
+        @self.sl.add_procedure('plots')
+        def plots():
+            plt.figure(figsize=(16, 12), dpi=100)
+            plt.plot([1, 2, 3])
+            self.sl.savefig('line')
+
+        run_id = self.sl.run([('plots', {})], description='plots')['id']
+        figure_name = self.sl.get_figures(run_id)[0]
+        figure_urls = json.loads(self.client.get('/api/figures/{}'.format(run_id)).data)
+        thumbnail_url = figure_urls['thumbnails'][0]
+        self.assertTrue(thumbnail_url.endswith('?size=thumb'))
+
+        thumbs_dir = os.path.join(self.sl.get_run_path(run_id), 'thumbs')
+        self.assertEqual(os.listdir(thumbs_dir), [figure_name])
+        shutil.rmtree(thumbs_dir)
+
+        url = '/api/figure/{}/{}'.format(run_id, figure_name)
+        response = self.client.get(url + '?size=thumb')
+        self.assertEqual(response.status_code, 200)
+        with Image.open(io.BytesIO(response.data)) as image:
+            self.assertEqual(image.size, (320, 240))
+        self.assertEqual(len(self.client.get(url).data), os.path.getsize(
+            os.path.join(self.sl.get_run_path(run_id), figure_name)
+        ))
+        self.assertEqual(self.client.get(url + '?size=huge').status_code, 400)
+        self.assertEqual(
+            self.client.get('/api/figure/{}/nope.png?size=thumb'.format(run_id)).status_code, 404
+        )
+
+    def test_no_thumbnail(self):
+        """ a figure no thumbnail can be made of is still saved, and is returned full size
+        """
+        import matplotlib.pyplot as plt
+
+        @self.sl.add_procedure('vector')
+        def vector():
+            plt.figure()
+            plt.plot([1, 2, 3])
+            self.sl.savefig('vec', format='svg')
+
+        run_id = self.sl.run([('vector', {})], description='svg')['id']
+        self.assertEqual(self.sl.get_single_run_result(run_id)['status'], 'complete')
+        figure_name = self.sl.get_figures(run_id)[0]
+        url = '/api/figure/{}/{}'.format(run_id, figure_name)
+        response = self.client.get(url + '?size=thumb')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.client.get(url).data)
+
+
+if __name__ == '__main__':
+    unittest.main()
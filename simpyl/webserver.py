@@ -1,9 +1,14 @@
-from flask import Flask, request, abort, send_file, url_for, jsonify
+from flask import Flask, Response, request, abort, send_from_directory, url_for, jsonify
+from werkzeug.security import safe_join
 import json
 import os
-import mimetypes
+import time
+from typing import Sequence
 
 from simpyl import Simpyl
+import simpyl.database as db
+import simpyl.run_manager as runm
+import simpyl.settings as s
 
 app = Flask(__name__, static_folder='site')
 sl = Simpyl()
@@ -46,8 +51,21 @@ def use_environment():
 
 @app.route('/api/runs/')
 def api_get_runs():
+    """ gets a page of runs. Query parameters:
+        after_id: the id of the last run of the previous page
+        limit: the maximum number of runs to return
+        order: 'desc' (newest first, the default) or 'asc'
+    """
+    after_id = request.args.get('after_id', type=int)
+    limit = request.args.get('limit', s.RUNS_PAGE_SIZE, type=int)
+    order = request.args.get('order', 'desc')
+    if order not in db.SORT_ORDERS or not 0 < limit <= s.RUNS_MAX_PAGE_SIZE:
+        abort(400)
+    run_results = sl.get_run_results(after_id=after_id, limit=limit, order=order)
+    # a full page means there may be more runs after it
+    next_after_id = run_results[-1]['id'] if len(run_results) == limit else None
     return jsonify(
-        {'run_results': [r for r in sl.get_run_results()]}
+        {'run_results': run_results, 'next_after_id': next_after_id}
     )
 
 
@@ -58,6 +76,21 @@ def api_get_run(run_result_id: int):
     )
 
 
+@app.route('/api/run/<int:run_result_id>/resume', methods=['POST'])
+def api_resume_run(run_result_id: int):
+    """ queues a new run which resumes a failed run, reusing the procedures that completed
+    """
+    if sl.get_single_run_result(run_result_id) is None:
+        abort(404)
+    try:
+        run_init = sl.resume_run_init(run_result_id)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    # the arguments are stored as the failed run was given them, so they are converted as they were then
+    run_result = sl.queue_run_init(run_init, run_init.get('convert_args_to_numbers', False))
+    return jsonify({'run_result': run_result}), 201
+
+
 @app.route('/api/newrun', methods=['POST'])
 def api_new_run():
     request_payload = request.get_json()
@@ -72,33 +105,159 @@ def api_new_run():
     return json.dumps(run_result), 201
 
 
+@app.route('/api/newsweep', methods=['POST'])
+def api_new_sweep():
+    """ queues a run for each combination of a grid of procedure arguments. The payload is a
+        run_init with a grid, and optionally n_samples and seed for a random search and
+        max_workers for the number of thread queue workers to run them with (see Simpyl.sweep)
+    """
+    request_payload = request.get_json()
+    if not request_payload or not all(
+            [k in request_payload for k in
+             ['description', 'proc_inits', 'grid']]):
+        abort(400)
+    for key in ['n_samples', 'seed', 'max_workers']:
+        if request_payload.get(key) is not None and not isinstance(request_payload[key], int):
+            abort(400)
+    procs = [
+        (proc_init['proc_name'],
+         dict((arg['name'], runm.to_number(arg['value']) if isinstance(arg['value'], str) else arg['value'])
+              for arg in proc_init.get('arguments', [])))
+        for proc_init in request_payload['proc_inits']
+    ]
+    try:
+        sweep = sl.sweep(
+            procs, request_payload['grid'], request_payload['description'],
+            n_samples=request_payload.get('n_samples'), seed=request_payload.get('seed'),
+            max_workers=request_payload.get('max_workers')
+        )
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    return jsonify({'sweep': sweep}), 201
+
+
+@app.route('/api/sweep/<int:sweep_id>')
+def api_get_sweep(sweep_id: int):
+    sweep = sl.get_sweep(sweep_id)
+    if sweep is None:
+        abort(404)
+    return jsonify({'sweep': sweep})
+
+
+@app.route('/api/workers')
+def api_get_workers():
+    return jsonify(
+        {'workers': sl.get_workers(), 'queue_size': sl.get_queue_size()}
+    )
+
+
+@app.route('/api/cache_stats')
+def api_get_cache_stats():
+    return jsonify({'cache_stats': sl.get_cache_stats()})
+
+
 @app.route('/api/log/<int:run_result_id>')
 def get_log(run_result_id: int):
-    return json.dumps({'log': sl.get_log(run_result_id)})
+    """ gets the log of a run. With ?offset=N only the lines written after byte N are returned,
+        along with the offset to ask for next time
+    """
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        log, offset = sl.read_log(run_result_id, max_bytes=None)
+    elif offset < 0:
+        abort(400)
+    else:
+        log, offset = sl.read_log(run_result_id, offset)
+    return json.dumps({'log': log, 'offset': offset})
+
+
+@app.route('/api/log/<int:run_result_id>/stream')
+def stream_log(run_result_id: int):
+    """ streams the lines of a run's log as server-sent events while the run is in progress.
+        Each batch of lines is followed by its byte offset as the event id, so a reconnecting
+        browser carries on where it left off. An 'end' event with the run's status is sent
+        when the run has finished
+    """
+    offset = request.headers.get('Last-Event-ID', type=int)
+    if offset is None:
+        offset = request.args.get('offset', 0, type=int)
+
+    def generate(offset: int):
+        while True:
+            # check the status before reading, so lines written just before the run finished are sent
+            run_result = sl.get_single_run_result(run_result_id)
+            finished = run_result is None or run_result['status'] not in s.UNFINISHED_STATUSES
+            log, offset = sl.read_log(run_result_id, offset)
+            if log:
+                yield ''.join('data: {}\n'.format(line) for line in log.splitlines())
+                yield 'id: {}\n\n'.format(offset)
+            elif finished:
+                yield 'event: end\ndata: {}\n\n'.format(run_result['status'] if run_result else 'missing')
+                return
+            else:
+                time.sleep(s.LOG_POLL_INTERVAL)
+
+    return Response(
+        generate(offset), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'}
+    )
 
 
 @app.route('/api/figures/<int:run_result_id>')
 def api_get_figures(run_result_id: int):
+    figure_names = sl.get_figures(run_result_id)
     figure_urls = [
         url_for(
             'api_get_figure', run_result_id=run_result_id, figure_name=fname, _external=True
         )
-        for fname in sl.get_figures(run_result_id)
+        for fname in figure_names
+    ]
+    thumbnail_urls = [
+        url_for(
+            'api_get_figure', run_result_id=run_result_id, figure_name=fname, size='thumb', _external=True
+        )
+        for fname in figure_names
     ]
-    return json.dumps({'figures': figure_urls})
+    return json.dumps({'figures': figure_urls, 'thumbnails': thumbnail_urls})
 
 
 @app.route('/api/figure/<int:run_result_id>/<string:figure_name>')
 def api_get_figure(run_result_id: int, figure_name: str):
-    img = sl.get_figure(run_result_id, figure_name)
-    with open(os.path.join(app.root_path, 'temp.image'), 'wb') as tmp:
-        tmp.write(img.read())
-    img.close()
-    return send_file('temp.image', mimetype=mimetypes.guess_type(figure_name)[0])
+    """ streams a figure from the run folder. Conditional and range requests are supported,
+        and as saved figures never change, browsers may cache them indefinitely
+
+        With ?size=thumb a downsampled copy is returned, which is made now if the figure doesn't have one.
+        Figures no thumbnail can be made of are returned full size
+    """
+    size = request.args.get('size', 'full')
+    run_path = os.path.abspath(sl.get_run_path(run_result_id))
+    if size == 'thumb':
+        figure_path = safe_join(run_path, figure_name)
+        if figure_path is None or not os.path.isfile(figure_path):
+            abort(404)
+        thumbnail_path = sl.get_thumbnail_path(run_result_id, figure_name)
+        if thumbnail_path is None:
+            figure_dir = run_path
+        else:
+            figure_dir, figure_name = os.path.split(thumbnail_path)
+    elif size == 'full':
+        figure_dir = run_path
+    else:
+        abort(400)
+    response = send_from_directory(
+        os.path.abspath(figure_dir), figure_name,
+        conditional=True, etag=True, max_age=s.FIGURE_MAX_AGE
+    )
+    response.cache_control.immutable = True
+    return response
 
 
-def run_server(simpyl_object: Simpyl):
+def run_server(simpyl_object: Simpyl,
+               max_workers: int = s.DEFAULT_MAX_WORKERS,
+               worker_type: str = s.DEFAULT_WORKER_TYPE,
+               preload: Sequence[str] = s.PRELOAD_MODULES):
     global sl
     sl = simpyl_object
-    sl.start_queue()
+    # process workers are forked here, before the webserver starts any threads. Only workers forked
+    # to replace a crashed worker are forked while the webserver's threads are running
+    sl.start_queue(max_workers, worker_type, preload)
     app.run(debug=False)